@@ -12,9 +12,13 @@ from flask import Flask, redirect
 
 import services.fileaccess as fa
 import services.dbaccess as dba
+import services.lightbackends as lb
 import services.lightctlwrapper as lw
+import services.lightmetrics as lm
+import services.lightshared as ls
 import services.ambinterpreter as ami
 import services.routines as rou
+import services.scenes as sc
 import services.scheduler as sch
 from services.reqhandler import cmdex_pb
 
@@ -44,9 +48,18 @@ def create_app(app):
         ])
     
     dba.init()
-    lw.init(app.config["lightctl_exec"])
+    shared = app.config.get("lightctl_shared", "")
+    lw.init(
+        lb.create(app.config),
+        app.config.get("lightctl_cache_ttl", 3),
+        app.config.get("lightctl_workers", 4),
+        app.config.get("lightctl_per_bridge", 2),
+        app.config.get("lightctl_rate", 0),
+        ls.SharedSnapshot(shared, app.config.get("lightctl_cache_ttl", 3)) \
+            if shared != "" else None)
     sch.init(dba)
     ami.init(fa, dba, lw)
+    sc.init(fa, lw)
     rou.init(app.config["routines"])
     
     app.register_blueprint(cmdex_pb)
@@ -63,6 +76,7 @@ def create_app(app):
 def after_request(exception):
     """ Free resources after the request."""
     dba.close_cached()
+    lm.finish_request()
     if exception != None: log.error(exception)
 
 
@@ -6,18 +6,33 @@ Interprets ambiscript and sets device states.
 """
 
 from ast import Module
-from functools import partial
-from jinja2 import Environment, select_autoescape
+from collections import OrderedDict
+from functools import lru_cache, partial
+from jinja2 import Environment, FileSystemLoader, Template, select_autoescape
+from jinja2.runtime import Macro
 from datetime import datetime, timedelta
 import logging
 import random
 import re
-from threading import Thread
-from time import sleep
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Callable, Iterable, Iterator
 from services.lightstates import State
 
 
 log = logging.getLogger(__file__)
+programs = dict()
+programs_mutex = Lock()
+compiled = OrderedDict()
+compiled_max = 4096
+compiled_mutex = Lock()
+environment = None
+environment_mutex = Lock()
+cancellations = dict()
+cancellations_mutex = Lock()
+cancellation_poll = 1
+macro_templates = dict()
+macro_exports = dict()
 
 
 def init(fileaccess, dbaccess, lightctlwrapper):
@@ -25,9 +40,16 @@ def init(fileaccess, dbaccess, lightctlwrapper):
     global lw
     global fa
     global dba
+    global environment
+    global macro_exports
     lw = lightctlwrapper
     fa = fileaccess
     dba = dbaccess
+    with environment_mutex:
+        environment = None
+        macro_templates.clear()
+        macro_exports = dict()
+        _template.cache_clear()
 
 
 def all(include_macros:bool=False):
@@ -63,58 +85,217 @@ def running() -> list[str]:
     return dba.get_tasks(['running'], ['ambient'])
 
 
+class _Cancellation:
+    """ Stop request of an ambient running in this process."""
+
+    def __init__(self):
+        """ Not cancelled yet."""
+        self.event = Event()
+        self.checked = monotonic()
+
+
 def terminated(id:str):
-    """ Checks whether an ambient was terminated."""
-    return dba.get_task_state(int(id)) != 'running'
+    """ Checks whether an ambient was terminated. Ambients running in this
+    process are stopped by their cancellation token, the database (stops
+    requested by other worker processes) is checked once per second."""
+    with cancellations_mutex: cancellation = cancellations.get(str(id))
+    if cancellation is None:
+        return dba.get_task_state(int(id)) != 'running'
+    if cancellation.event.is_set(): return True
+    if monotonic() - cancellation.checked >= cancellation_poll:
+        cancellation.checked = monotonic()
+        if dba.get_task_state(int(id)) != 'running': cancellation.event.set()
+    return cancellation.event.is_set()
 
 
 def terminate(id:str):
-    """ Checks whether an ambient was terminated."""
-    return dba.clear_tasks([int(id)])
+    """ Terminates an ambient, a sleeping ambient wakes up immediately."""
+    result = dba.clear_tasks([int(id)])
+    with cancellations_mutex: cancellation = cancellations.get(str(id))
+    if cancellation is not None: cancellation.event.set()
+    return result
 
 
 def run(name):
     """ Restores an ambient."""
     id = dba.add_task('ambient', name, 'running')
-    Thread(target=_run, args=[id, name]).start()
+    with cancellations_mutex: cancellations[str(id)] = _Cancellation()
+    Thread(target=_run_cancellable, args=[id, name]).start()
+
+
+def _run_cancellable(id, name):
+    """ Runs the ambient, drops the cancellation token afterwards."""
+    try: _run(id, name)
+    finally:
+        with cancellations_mutex: cancellations.pop(str(id), None)
+
+
+def _pause(id:str, seconds:float):
+    """ Sleeps, returns early if the ambient is terminated."""
+    end = monotonic() + seconds
+    with cancellations_mutex: cancellation = cancellations.get(str(id))
+    while not terminated(id):
+        remaining = end - monotonic()
+        if remaining <= 0: return
+        if cancellation is None: sleep(min(remaining, cancellation_poll))
+        else: cancellation.event.wait(min(remaining, cancellation_poll))
 
 
 def _run(
     id,
     name,
     states_old:list[State]=None,
-    changed_ids:set[str]=set(),
+    changed_ids:set[str]=None,
     delay_seconds:int=0,
-    context:dict={}):
+    context:dict=None):
     """ Restores an ambient by processing line for line."""
-    if delay_seconds > 0:  sleep(delay_seconds)
+    if changed_ids is None: changed_ids = set()
+    if context is None: context = dict()
+    if delay_seconds > 0:  _pause(id, delay_seconds)
     context['time'] = datetime.now()
     if states_old == None: states_old = lw.states()
-    script = fa.read_file(["ambients", name])
-    tokens = prepare(script)
+    statements = _program(name)
     if len(context) == 1: predefined(context)
-    _interpret_tokens(id, tokens, states_old, changed_ids, context)
+    # shadow model of the devices, updated with every state sent
+    if 'devices' not in context:
+        context['devices'] = {s.id: s for s in states_old}
+    _interpret_tokens(id, statements, states_old, changed_ids, context)
     dba.clear_tasks([id])
 
 
+def _program(name:str) -> Iterable[tuple]:
+    """ Gets the compiled statements of an ambient. Scripts without template
+    syntax are compiled once per modification of the script or a macro,
+    templated scripts are rendered and compiled while they run."""
+    key = _modified(name)
+    with programs_mutex: cached = programs.get(name)
+    if cached is not None and cached[0] == key: return cached[1]
+    script = fa.read_file(["ambients", name])
+    statements = _statements(_tokens(script))
+    if not _templated(script):
+        statements = list(statements)
+        with programs_mutex: programs[name] = (key, statements)
+    return statements
+
+
+def _modified(name:str) -> tuple:
+    """ Modification times of the script and the macros."""
+    macro_files, _ = fa.list_files(['ambients', 'macros'])
+    return (fa.modified(["ambients", name]),
+        *[(m, fa.modified(['ambients', 'macros', m])) for m in macro_files])
+
+
+def _templated(script:str) -> bool:
+    """ Checks whether the script uses template syntax (may render
+    differently every time)."""
+    return any(t in script for t in ["{{", "{%", "{#"])
+
+
+def _statements(tokens:Iterable[str]) -> Iterator[tuple]:
+    """ Compiles the tokens: variable assignments, instructions depending on
+    variables (compiled when run) and compiled instructions."""
+    for token in tokens:
+        if token.startswith(("ID", "#")) or token == "":
+            continue
+        if token.startswith("$") and token.find("=") > 0:
+            yield ("assign", token)
+        elif "$" in token:
+            yield ("substitute", token)
+        else:
+            yield ("run", _compile(token))
+
+
 def prepare(template):
     """ Prepare templates."""
-    template = f'{macros()}\n{template}'
-    env = Environment(autoescape=select_autoescape())
-    for m in [Common, random]: 
-        _map_methods(env.globals, m)
-    tokens_str = env.from_string(template).render()
-    tokens = fa.clean_lines(tokens_str)
-    def _clean_token(t:str):
-        while '  ' in t: t = t.replace('  ', ' ')
-        return t
-    tokens = [_clean_token(t) for t in tokens]
-    log.debug(f"template:\n{template}")
+    tokens = list(_tokens(template))
     def join(ts): return ('\n'.join(ts))
     log.debug(f"instructions:\n{join(tokens)}")
     return tokens
 
 
+def _tokens(template:str) -> Iterator[str]:
+    """ Renders the template and yields the cleaned tokens as soon as their
+    line is complete (the rendered script is never kept as a whole)."""
+    log.debug(f"template:\n{template}")
+    # reloads changed macros, the compiled script sees the globals
+    _environment()
+    for line in _lines(_template(template).generate()):
+        token = line.strip()
+        if token == "": continue
+        while '  ' in token: token = token.replace('  ', ' ')
+        yield token
+
+
+def _lines(chunks:Iterable[str]) -> Iterator[str]:
+    """ Joins rendered chunks into lines."""
+    rest = ""
+    for chunk in chunks:
+        lines = (rest + chunk).split("\n")
+        rest = lines.pop()
+        yield from lines
+    yield rest
+
+
+@lru_cache(maxsize=64)
+def _template(source:str) -> Template:
+    """ Compiles a script (the macros are globals)."""
+    return _environment().from_string(source)
+
+
+def _environment() -> Environment:
+    """ Gets the environment shared by all ambients. The macros are loaded
+    as templates, a changed macro file is compiled again."""
+    global environment
+    with environment_mutex:
+        if environment is None:
+            environment = Environment(
+                loader=FileSystemLoader(fa.share_path(['ambients', 'macros'])),
+                autoescape=select_autoescape(default=True),
+                auto_reload=True)
+            for m in [Common, random]:
+                _map_methods(environment.globals, m)
+        _load_macros(environment)
+        return environment
+
+
+def _load_macros(env:Environment):
+    """ Exports the macros as globals. Once a macro file is new, changed or
+    removed, the modules of all files are created again: first to learn
+    the exported names, then with every name defined (a macro may call the
+    macros of other files). The macros are called by name, so the modules
+    use the latest macros. Running ambients keep the macros they started
+    with, the new exports are swapped in at once."""
+    global macro_exports
+    macro_files, _ = fa.list_files(['ambients', 'macros'])
+    # the loader checks the modification time
+    templates = {name: env.get_template(name) for name in macro_files}
+    if templates == macro_templates: return
+    exports = dict()
+    for template in templates.values(): exports.update(_exports(template))
+    # new names are added before the stale ones are dropped
+    env.globals.update({k: partial(_call_macro, exports, k) \
+        if isinstance(v, Macro) else v for k, v in exports.items()})
+    for template in templates.values(): exports.update(_exports(template))
+    for stale in [k for k in macro_exports if k not in exports]:
+        env.globals.pop(stale, None)
+    macro_exports = exports
+    macro_templates.clear()
+    macro_templates.update(templates)
+    log.info(f"Macros loaded from {', '.join(templates.keys())}: "
+        f"{', '.join(exports.keys())}")
+
+
+def _exports(template:Template) -> dict:
+    """ Creates the module of a macro file, gets its exports."""
+    return {k: v for k, v in template.make_module().__dict__.items() \
+        if not k.startswith('_')}
+
+
+def _call_macro(exports:dict, name:str, *args, **kwargs):
+    """ Calls the macro of the exports."""
+    return exports[name](*args, **kwargs)
+
+
 def _map_methods(mappings:dict, module:Module) -> dict:
     """ Maps the methods."""
     methods = [m for m in dir(module) \
@@ -141,70 +322,116 @@ class Common:
 
 def _interpret_tokens(
     id:str,
-    tokens:list[str],
+    statements:list[tuple],
     states_old:list[State],
     changed_ids:set[str],
-    context:dict={}):
+    context:dict):
     """ Interprets the script."""
-    for token in tokens:
+    for kind, statement in statements:
         if terminated(id): 
-            lw.set_states(states_old, changed_ids)
+            lw.set_states(states_old, changed_ids, _origin(id))
             return
-        if token.startswith(("ID", "#")) or token == "":
-            continue
-        if token.startswith("$") and token.find("=") > 0: 
-            _add_variable(token, context)
+        if kind == "assign":
+            _add_variable(statement, context)
             continue
-        token = _substitute(token, context)
-        _interpret_token(id, token, states_old, changed_ids, context)
+        if kind == "substitute":
+            statement = _compile(_substitute(statement, context))
+        _interpret_token(id, statement, states_old, changed_ids, context)
 
 
 def _interpret_token(
     id:str,
-    token:str,
+    instruction:tuple,
     states_old:list[State],
     changed_ids:set[str],
-    context:dict={}):
-        """ Interprets a single token."""
-        log.debug(token)
+    context:dict):
+        """ Interprets a single compiled instruction."""
+        log.debug(instruction)
         # check if terminated
         if terminated(id): return
+        kind = instruction[0]
         # repetitions
-        if token.startswith("repeat"):
-            repeat = token.partition(" ")[2]
-            times, _, repeat = repeat.partition(" ")
-            repeat = repeat.strip()
-            for _ in range(int(times)):
-                _interpret_token(id, repeat, states_old, changed_ids)
-            return
-        # process asterisk "for all devices"
-        if token.startswith("*"):
+        if kind == "repeat":
+            for _ in range(instruction[1]):
+                _interpret_token(id, instruction[2], states_old, changed_ids, context)
+        # asterisk "for all devices"
+        elif kind == "all":
             for i in [s.id for s in states_old]:
-                _interpret_token(id, token.replace("*", str(i)), states_old, changed_ids)
-            return
-        # process comma-separated list
-        parts = token.partition(" ")
-        if parts[0].find(",") > 0:
-            for i in parts[0].split(","):
-                _interpret_token(id, f"{i} {parts[2]}", states_old, changed_ids)
-            return
-        # multiple instructions in a single line
-        if token.find("\\") > 0:
-            for part in token.split("\\"):
-                _interpret_token(id, part.strip(), states_old, changed_ids, context)
-            return
+                _interpret_token(id, _compile(instruction[1].replace("*", str(i))),
+                    states_old, changed_ids, context)
+        # comma-separated list, multiple instructions in a single line
+        elif kind == "sequence":
+            for part in instruction[1]:
+                _interpret_token(id, part, states_old, changed_ids, context)
         # sleep
-        elif token.startswith("sleep"): _sleep(token, context)
-        elif token.startswith("wait"):  _wait(token, context)
+        elif kind == "sleep": _sleep(id, instruction[1](None), context)
+        elif kind == "wait":  _wait(id, instruction[1], context)
         # reset
-        elif token.startswith("reset"):
-            lw.set_states(states_old, changed_ids)
+        elif kind == "reset":
+            lw.set_states(states_old, changed_ids, _origin(id))
+            devices = context.setdefault('devices', {})
+            for s in states_old:
+                if s.id in changed_ids: devices[s.id] = s
             changed_ids.clear()
+        # read the live device states into the shadow model
+        elif kind == "sync":
+            context['devices'] = {s.id: s for s in lw.states()}
         # call
-        elif token.startswith("call"):
-            _run(id, token.partition(" ")[2], states_old, changed_ids, 0, context)
+        elif kind == "call":
+            _run(id, instruction[1], states_old, changed_ids, 0, context)
         # set
-        else: _set(token, states_old, changed_ids)
+        else: _set(id, instruction, states_old, changed_ids, context)
+
+
+def _compile(token:str) -> tuple:
+    """ Compiles a token (variables substituted), the instructions are
+    memoized."""
+    with compiled_mutex:
+        instruction = compiled.get(token)
+        if instruction is not None:
+            compiled.move_to_end(token)
+            return instruction
+    instruction = _compile_token(token)
+    with compiled_mutex:
+        compiled[token] = instruction
+        if len(compiled) > compiled_max: compiled.popitem(last=False)
+    return instruction
+
+
+def _compile_token(token:str) -> tuple:
+    """ Parses a token into an instruction."""
+    # repetitions
+    if token.startswith("repeat"):
+        repeat = token.partition(" ")[2]
+        times, _, repeat = repeat.partition(" ")
+        return ("repeat", int(times), _compile(repeat.strip()))
+    # asterisk "for all devices" (resolved when run)
+    if token.startswith("*"):
+        return ("all", token)
+    # comma-separated list
+    parts = token.partition(" ")
+    if parts[0].find(",") > 0:
+        return ("sequence",
+            [_compile(f"{i} {parts[2]}") for i in parts[0].split(",")])
+    # multiple instructions in a single line
+    if token.find("\\") > 0:
+        return ("sequence", [_compile(p.strip()) for p in token.split("\\")])
+    if token.startswith("sleep"):
+        return ("sleep", _compile_value(token.partition(" ")[2], "sleep"))
+    if token.startswith("wait"):
+        return ("wait", token.partition(" ")[2])
+    if token.startswith("reset"):
+        return ("reset",)
+    if token == "sync":
+        return ("sync",)
+    if token.startswith("call"):
+        return ("call", token.partition(" ")[2])
+    # set: ID PWR HUE SAT BRI [NAME]
+    values = [c for c in token.split(" ") if c != "" and not c.isspace()]
+    values += ["-"] * (6 - len(values))
+    return ("set", values[0], values[1],
+        [_compile_value(v, a) for v, a in zip(values[2:5], ["hue", "sat", "bri"])],
+        values[5:])
 
 
 def _add_variable(assignment:str, context:dict):
@@ -228,86 +455,86 @@ def _substitute(token:str, context:dict):
     return token
 
 
-def _set(instruction:str, states_old:list[State], changed_ids:set[str]):
-    """ Processes a single instruction and sets the values."""
-    instr_interpolated = _interpolate_instruction(instruction, states_old)
-    log.debug(f"Interpolated:\n{instruction}\n{instr_interpolated}")
-    state = State(instr_interpolated)
+def _set(
+    id:str,
+    instruction:tuple,
+    states_old:list[State],
+    changed_ids:set[str],
+    context:dict):
+    """ Evaluates a compiled set instruction against the shadow model of
+    the device and sets the values."""
+    _, device, pwr, values, rest = instruction
+    devices = context.setdefault('devices', {})
+    # devices missing in the shadow model are read once
+    state_now = devices.get(device)
+    if state_now is None: state_now = devices[device] = lw.state("dev", device)
+    values = [str(v(state_now)) for v in values]
+    state = State(" ".join([device, pwr, *values, *rest]))
+    log.debug(f"Interpolated: {state.str()}")
     changed_ids.add(state.id)
-    lw.set_state(state)
+    def _value(attr):
+        value = getattr(state, attr)
+        return getattr(state_now, attr) if value == "-" else value
+    devices[device] = State.of(device, _value("pwr"), _value("hue"),
+        _value("sat"), _value("bri"), state_now.name)
+    lw.set_state(state, _origin(id))
 
 
-def _interpolate_instruction(instr:str, states_old:list[State]):
-    """ Replaces instructions with random values."""
-    # find old value
-    id = instr.partition(" ")[0]
-    # sanitize values (6 columns)
-    values = [c for c in instr.split(" ") if c != "" and not c.isspace()]
-    values += ["-"] * (6 - len(values))
-    # current state needed for calculations if any value is an incremental value
-    state_now = lw.state("dev", id)
-    # interpolate
-    values_interpolated = []
-    for idx, value in enumerate(values):
-        type = "id"  if idx == 0 else \
-               "pwr" if idx == 1 else \
-               "hue" if idx == 2 else \
-               "sat" if idx == 3 else \
-               "bri" if idx == 4 else \
-               "name"
-        if type in ["hue", "sat", "bri"]:
-            # tanslate
-            interpolated = str(_interpolate_value(value, type, state_now))
-            values_interpolated.append(interpolated)
-        else: values_interpolated.append(value)
-    instr_interpolated = " ".join(values_interpolated)
-    return instr_interpolated
-
-
-def _interpolate_value(val:str, attr:str=None, state:State=None) -> str:
-    """ interpolates a single value (such as '+ru(0,30)')."""
-    if val == "-": return val
+def _origin(id:str) -> str:
+    """ Origin of the light commands (dispatch priority)."""
+    return f"ambient/{id}"
+
+
+def _compile_value(val:str, attr:str=None) -> Callable[[State], Any]:
+    """ Compiles a single value (such as '+ru(0,30)') into a function of the
+    current device state."""
+    if val == "-": return lambda state: val
     # integer found, sanitze it
     if type(val) == int or re.match("^[0-9]*$", str(val)): 
-        val = int(val)
-        if   attr == "hue":          val %= 360
-        elif attr in ["bri", "sat"]: val = min(100, max(0, val))
-        elif attr == "sleep":        val = max(0, val)
-        return val
+        value = _sanitize(int(val), attr)
+        return lambda state: value
     # increment/decrement, requires calculation
     if val.startswith(("+", "-")):
-        if attr not in ["hue", "sat", "bri"]: return int(val)
-        assert state != None
-        assert attr != None
-        now   = int(getattr(state, attr))
-        delta = int(_interpolate_value(val[1:], attr, state))
-        if val[0] == "+": new = now + delta
-        else:             new = now - delta
-        return _interpolate_value(new, attr, state)
+        if attr not in ["hue", "sat", "bri"]:
+            value = int(val)
+            return lambda state: value
+        delta = _compile_value(val[1:], attr)
+        sign = 1 if val[0] == "+" else -1
+        def _relative(state:State):
+            assert state != None
+            now = int(getattr(state, attr))
+            return _sanitize(now + sign * int(delta(state)), attr)
+        return _relative
     # random.uniform
     if val.startswith("ru(") and val.endswith(")"):
         match = re.match(r'ru\(([-+]?\d+),\s*([-+]?\d+)\)', val)
-        lower = int(_interpolate_value(match.group(1), None, state))
-        upper = int(_interpolate_value(match.group(2), None, state))
-        new   = int(random.uniform(lower, upper))
-        return _interpolate_value(new, attr, state)
+        lower = int(_compile_value(match.group(1))(None))
+        upper = int(_compile_value(match.group(2))(None))
+        return lambda state: \
+            _sanitize(int(random.uniform(lower, upper)), attr)
     # random.choice
     if val.startswith("rc(") and val.endswith(")"):
-        choices = map(lambda v: int(_interpolate_value(v, attr, state)), \
-            val[3:-1].split(","))
-        new = random.choice(list(choices))
-        return _interpolate_value(new, attr, state)
+        choices = [_compile_value(v, attr) for v in val[3:-1].split(",")]
+        return lambda state: \
+            _sanitize(int(random.choice(choices)(state)), attr)
     raise Exception(f"'{val}' ({attr}) cannot be processed")
 
 
-def _sleep(timeout:str, context:dict):
+def _sanitize(val:int, attr:str) -> int:
+    """ Keeps a value in the range of the attribute."""
+    if   attr == "hue":          val %= 360
+    elif attr in ["bri", "sat"]: val = min(100, max(0, val))
+    elif attr == "sleep":        val = max(0, val)
+    return val
+
+
+def _sleep(id:str, pause:int, context:dict):
     """ Pause execution."""
-    pause = _interpolate_value(timeout.partition(" ")[2], "sleep", None)
     pause = int(pause)
     time_old = context['time']
     time_new = time_old + timedelta(milliseconds=pause*1000)
     pause_delta = (time_new - datetime.now()).total_seconds()
-    if pause_delta > 0: sleep(pause_delta)
+    if pause_delta > 0: _pause(id, pause_delta)
     log.debug(f"{time_old} - sleep {pause_delta} - {time_new}")
     context['time'] = time_new
 
@@ -315,9 +542,8 @@ def _sleep(timeout:str, context:dict):
 from datetime import datetime, timedelta
 from time import sleep
 
-def _wait(timeout: str, context: dict):
+def _wait(id: str, pause: str, context: dict):
     """Schedule execution."""
-    pause = timeout.partition(" ")[2]
     now = datetime.now()
     if '-' in pause:
         new = datetime.strptime(pause, "%Y-%m-%d %H:%M")
@@ -327,7 +553,7 @@ def _wait(timeout: str, context: dict):
         if new < now: new += timedelta(days=1)
     delta = new - now
     delta_seconds = delta.total_seconds()
-    if delta_seconds > 0: sleep(delta_seconds)
+    if delta_seconds > 0: _pause(id, delta_seconds)
     context['time'] = new
 
 
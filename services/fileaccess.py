@@ -165,6 +165,11 @@ def read_directory_meta_data(path: list[str]):
     return meta
 
 
+def modified(path:list[str]) -> int:
+    """ Gets the modification time of a file (nanoseconds)."""
+    return os.stat(share_path(path)).st_mtime_ns
+
+
 def update_file(path:list[str], content:str, overwrite:bool):
     """ Updates a file (overwrite or append)."""
     mode = "w" if overwrite else "a"
@@ -255,6 +260,7 @@ def is_essential(path:list[str]):
             ["documents", "templates"],
             ["ambients"],
             ["ambients", "macros"],
+            ["scenes"],
             ["temp"],
             ["temp", "logs"],
         ]:
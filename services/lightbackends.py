@@ -0,0 +1,400 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+"""
+Backends talking to the bridge: lightctl (external program) or the bridge
+REST API (pooled HTTP connections).
+"""
+
+import copy
+import http.client
+import json
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, LifoQueue
+from services.lightctlsession import CommandError, END_OK, Session, SessionError
+from services.lightstates import State, States
+
+
+log = logging.getLogger(__file__)
+
+
+class BridgeUnavailable(Exception):
+    """ The bridge failed repeatedly, calls are rejected until it answers
+    again."""
+
+
+class Backend:
+    """ Reads and writes device and group states."""
+
+    def read(self, type:str="dev", id:str=None) -> list[State]:
+        """ Reads all states or the state of a single device or group."""
+        raise NotImplementedError()
+
+    def write(self, states:list[State], type:str="dev"):
+        """ Writes the states in order."""
+        raise NotImplementedError()
+
+    def exec(self, cmd, type = "dev", parameters = "", brief = True) -> str:
+        """ Executes a raw lightctl command."""
+        raise NotImplementedError(
+            f"'{cmd}' not supported by {self.__class__.__name__}")
+
+    def bridge(self, id:str) -> str:
+        """ Gets the name of the bridge serving the device or group."""
+        return ""
+
+    def close(self):
+        """ Frees the resources."""
+
+
+class LightctlBackend(Backend):
+    """ Calls lightctl, either once per round-trip or as long-lived
+    session."""
+
+    def __init__(self, executable:str, use_session:bool=False,
+            timeout:float=10):
+        """ Wraps the lightctl executable, calls are killed after the
+        timeout (seconds)."""
+        self.executable = executable
+        self.timeout = timeout
+        self.session = Session(executable, timeout=timeout) \
+            if use_session else None
+
+    def read(self, type:str="dev", id:str=None) -> list[State]:
+        """ Reads the states."""
+        parameters = "" if id is None else str(id)
+        return States(self.exec("state", type, parameters)).items
+
+    def write(self, states:list[State], type:str="dev"):
+        """ Writes the states with a single round-trip."""
+        self.exec_many([command("set", type, s.str()) for s in states])
+
+    def exec(self, cmd, type = "dev", parameters = "", brief = True) -> str:
+        """ Executes the wrapped LightCtl command."""
+        return self.exec_many([command(cmd, type, parameters, brief)])[0]
+
+    def exec_many(self, cmds:list[str]) -> list[str]:
+        """ Executes the prepared LightCtl commands in order with a single
+        round-trip (pipelined in the session, otherwise in a single shell)."""
+        log.debug("\n".join(cmds))
+        if self.session is not None and self.session.usable():
+            try: return self.session.exec_many(cmds)
+            except SessionError as e: log.warning(e)
+        if len(cmds) == 1: return [self._exec_once(cmds[0])]
+        # single shell, the outputs are separated by the session marker
+        output = self._exec_once(" && ".join(
+            [f"{self.executable} {c} && echo '{END_OK}'" for c in cmds]), False)
+        results = [[]]
+        for line in output.splitlines(True):
+            if line.rstrip("\n") == END_OK: results.append([])
+            else: results[-1].append(line)
+        return ["".join(r) for r in results[:len(cmds)]]
+
+    def close(self):
+        """ Stops the session."""
+        if self.session is not None: self.session.close()
+
+    def _exec_once(self, cmd, prefix:bool=True) -> str:
+        """ Executes the command in a new process (the whole process group
+        is killed after the timeout)."""
+        cmd = f"{self.executable} {cmd}" if prefix else cmd
+        with subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE,
+                start_new_session = True) as process:
+            try: output, _ = process.communicate(timeout = self.timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.communicate()
+                raise
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(
+                    process.returncode, cmd, output)
+        return output.decode("utf-8")
+
+
+def command(cmd, type = "dev", parameters = "", brief = True) -> str:
+    """ Composes the LightCtl command."""
+    if type == "grp":    cmd += "-group"
+    if parameters != "": cmd += " " + parameters
+    if brief:            cmd += " --brief"
+    return cmd
+
+
+class HttpBackend(Backend):
+    """ Talks to the bridge REST API over keep-alive connections. Values are
+    converted to the lightctl ranges (hue 0-360, sat/bri 0-100)."""
+
+    def __init__(self, address:str, user:str, connections:int=4,
+            timeout:float=5):
+        """ Sets the bridge address (host[:port]) and the user."""
+        self.address = address
+        self.user = user
+        self.timeout = timeout
+        self.pool = LifoQueue(connections)
+
+    def read(self, type:str="dev", id:str=None) -> list[State]:
+        """ Reads the states."""
+        resource = "lights" if type != "grp" else "groups"
+        if id is not None:
+            return [self._state(type, str(id),
+                self._request("GET", f"{resource}/{id}"))]
+        return [self._state(type, i, v) \
+            for i, v in self._request("GET", resource).items()]
+
+    def write(self, states:list[State], type:str="dev"):
+        """ Writes the states (a request per state, same connection)."""
+        for s in states:
+            path = f"lights/{s.id}/state" if type != "grp" \
+                else f"groups/{s.id}/action"
+            body = {"on": s.pwr == "on"}
+            if s.hue != "-": body["hue"] = round(int(s.hue) % 360 * 65535 / 360)
+            if s.sat != "-": body["sat"] = round(int(s.sat) * 254 / 100)
+            if s.bri != "-": body["bri"] = max(1, round(int(s.bri) * 254 / 100))
+            self._request("PUT", path, body)
+
+    def close(self):
+        """ Closes the pooled connections."""
+        while True:
+            try: self.pool.get_nowait().close()
+            except Empty: return
+
+    def _state(self, type:str, id:str, value:dict) -> State:
+        """ Converts the bridge data."""
+        values = value.get("state" if type != "grp" else "action", {})
+        def _scale(attr, maximum, scale):
+            if attr not in values: return "-"
+            return str(round(values[attr] * scale / maximum))
+        pwr = "on" if values.get("on") or \
+            value.get("state", {}).get("any_on") else "off"
+        memids = value.get("lights", []) if type == "grp" else None
+        return State.of(id, pwr,
+            _scale("hue", 65535, 360), _scale("sat", 254, 100),
+            _scale("bri", 254, 100), value.get("name", ""), memids)
+
+    def _request(self, method:str, path:str, body:dict=None):
+        """ Sends a request with a pooled connection, a dropped keep-alive
+        connection is replaced once."""
+        url = f"/api/{self.user}/{path}"
+        payload = None if body is None else json.dumps(body)
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, url, payload,
+                    {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                if attempt > 0: raise
+                log.info(f"Reconnecting to {self.address}: {e}")
+                continue
+            if response.will_close: connection.close()
+            else: self._release(connection)
+            # the bridge rejected the request (e.g. unknown ID)
+            if 400 <= response.status < 500:
+                raise CommandError(f"{method} {path}: HTTP {response.status}")
+            if response.status != 200:
+                raise http.client.HTTPException(
+                    f"{method} {path}: HTTP {response.status}")
+            answer = json.loads(data)
+            # errors (e.g. unauthorized user, unknown ID) come with status 200
+            if isinstance(answer, list):
+                errors = [r["error"].get("description", str(r["error"])) \
+                    for r in answer if isinstance(r, dict) and "error" in r]
+                if len(errors) > 0:
+                    raise CommandError(f"{method} {path}: {', '.join(errors)}")
+            return answer
+
+    def _connection(self) -> http.client.HTTPConnection:
+        """ Takes a pooled or new connection."""
+        try: return self.pool.get_nowait()
+        except Empty:
+            return http.client.HTTPConnection(
+                self.address, timeout=self.timeout)
+
+    def _release(self, connection:http.client.HTTPConnection):
+        """ Returns the connection to the pool (closed if the pool is full)."""
+        try: self.pool.put_nowait(connection)
+        except Full: connection.close()
+
+
+class Bridges(Backend):
+    """ Several bridges with a shared ID space. IDs of the first bridge are
+    kept, IDs of the other bridges are namespaced ('<bridge>:<id>')."""
+
+    def __init__(self, backends:dict[str, Backend]):
+        """ Sets the backends by bridge name (first one is the default)."""
+        self.backends = backends
+        self.default = next(iter(backends))
+        self.pool = ThreadPoolExecutor(len(backends))
+
+    def bridge(self, id:str) -> str:
+        """ Gets the bridge of the device or group."""
+        return self.route(id)[0]
+
+    def route(self, id:str) -> tuple[str, str]:
+        """ Routes a public ID to the bridge and its local ID."""
+        bridge, _, local = str(id).rpartition(":")
+        if bridge in self.backends: return bridge, local
+        return self.default, str(id)
+
+    def read(self, type:str="dev", id:str=None) -> list[State]:
+        """ Reads the states, all bridges are queried concurrently."""
+        if id is not None:
+            bridge, local = self.route(id)
+            return [self._public(bridge, s) \
+                for s in self.backends[bridge].read(type, local)]
+        def _read(bridge):
+            return [self._public(bridge, s) \
+                for s in self.backends[bridge].read(type)]
+        results = self.pool.map(_read, self.backends.keys())
+        return [s for states in results for s in states]
+
+    def write(self, states:list[State], type:str="dev"):
+        """ Writes the states, the bridges are written concurrently."""
+        by_bridge = dict()
+        for s in states:
+            bridge, local = self.route(s.id)
+            s_local = copy.copy(s)
+            s_local.id = local
+            by_bridge.setdefault(bridge, []).append(s_local)
+        def _write(bridge): self.backends[bridge].write(by_bridge[bridge], type)
+        # the dispatcher already sends writes of different bridges in parallel
+        if len(by_bridge) == 1: _write(next(iter(by_bridge)))
+        else: list(self.pool.map(_write, by_bridge.keys()))
+
+    def exec(self, cmd, type = "dev", parameters = "", brief = True) -> str:
+        """ Executes a raw lightctl command (default bridge)."""
+        return self.backends[self.default].exec(cmd, type, parameters, brief)
+
+    def close(self):
+        """ Closes all backends."""
+        for b in self.backends.values(): b.close()
+        self.pool.shutdown()
+
+    def _public(self, bridge:str, state:State) -> State:
+        """ Namespaces the IDs of the state."""
+        if bridge == self.default: return state
+        def _id(i): return f"{bridge}:{i}"
+        memids = None if not state.group else [_id(m) for m in state.memids]
+        return State.of(_id(state.id), state.pwr, state.hue, state.sat,
+            state.bri, state.name, memids)
+
+
+class Breaker(Backend):
+    """ Circuit breaker: after consecutive connectivity failures (timeouts,
+    network and HTTP server errors), calls fail fast with BridgeUnavailable.
+    The bridge is probed in the background until it answers again. Failed
+    commands (non-zero exit, HTTP client errors) are only counted when all
+    states are read: that command is always valid, lightctl fails it when
+    the bridge is unreachable."""
+
+    outages = (OSError, subprocess.TimeoutExpired, http.client.HTTPException,
+        SessionError)
+    command_errors = (CommandError, subprocess.CalledProcessError)
+
+    def __init__(self, backend:Backend, failures:int=3, probe:float=10):
+        """ Wraps the backend, opens after the failures, probes every probe
+        seconds."""
+        self.backend = backend
+        self.failures = failures
+        self.probe = probe
+        self.failed = 0
+        self.opened = None
+        self.closed = threading.Event()
+        self.mutex = threading.Lock()
+
+    def read(self, type:str="dev", id:str=None) -> list[State]:
+        """ Reads the states."""
+        return self._call(self.backend.read, type, id, outage=id is None)
+
+    def write(self, states:list[State], type:str="dev"):
+        """ Writes the states."""
+        self._call(self.backend.write, states, type)
+
+    def exec(self, cmd, type = "dev", parameters = "", brief = True) -> str:
+        """ Executes a raw lightctl command."""
+        return self._call(self.backend.exec, cmd, type, parameters, brief)
+
+    def bridge(self, id:str) -> str:
+        """ Gets the name of the bridge."""
+        return self.backend.bridge(id)
+
+    def available(self) -> bool:
+        """ Checks whether calls are passed to the bridge."""
+        with self.mutex: return self.opened is None
+
+    def close(self):
+        """ Stops probing and closes the backend."""
+        self.closed.set()
+        self.backend.close()
+
+    def _call(self, method, *args, outage:bool=False):
+        """ Calls the backend unless the breaker is open. A failed command
+        counts as failure if it cannot fail otherwise (outage)."""
+        with self.mutex:
+            if self.opened is not None:
+                raise BridgeUnavailable(
+                    f"Bridge unavailable for {time.monotonic() - self.opened:.0f} s")
+        try: result = method(*args)
+        except self.outages as e:
+            self._failure(e)
+            raise
+        except self.command_errors as e:
+            if outage: self._failure(e)
+            raise
+        with self.mutex: self.failed = 0
+        return result
+
+    def _failure(self, error:Exception):
+        """ Counts a failure, opens the breaker."""
+        with self.mutex:
+            self.failed += 1
+            if self.failed < self.failures or self.opened is not None: return
+            self.opened = time.monotonic()
+        log.warning(f"Bridge failed {self.failed} times, last: {error}")
+        threading.Thread(target=self._probe, daemon=True).start()
+
+    def _probe(self):
+        """ Reads the states until the bridge answers, closes the breaker."""
+        while not self.closed.wait(self.probe):
+            try: self.backend.read("dev")
+            except Exception as e:
+                log.info(f"Bridge still unavailable: {e}")
+                continue
+            with self.mutex:
+                self.opened = None
+                self.failed = 0
+            log.info("Bridge available again.")
+            return
+
+
+def create(config:dict) -> Backend:
+    """ Creates the configured backend ('lightctl' or 'http') guarded by a
+    circuit breaker, several bridges are configured as 'bridges' (name:
+    backend configuration)."""
+    if "bridges" in config:
+        return Bridges({name: create(c) \
+            for name, c in config["bridges"].items()})
+    backend = config.get("lightctl_backend", "lightctl")
+    timeout = config.get("lightctl_timeout", 10)
+    if backend == "http":
+        created = HttpBackend(
+            config["bridge_address"],
+            config["bridge_user"],
+            config.get("lightctl_per_bridge", 2),
+            timeout)
+    elif backend == "lightctl":
+        created = LightctlBackend(
+            config["lightctl_exec"],
+            config.get("lightctl_session", False),
+            timeout)
+    else: raise Exception(f"Unknown backend '{backend}'")
+    return Breaker(created,
+        config.get("lightctl_failures", 3),
+        config.get("lightctl_probe", 10))
@@ -0,0 +1,109 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+"""
+Caches device and group states for a short time. Concurrent readers of a
+missing entry share a single load. If loading fails, the last value is
+served and marked stale.
+"""
+
+import logging
+import time
+from threading import Event, Lock
+from typing import Any, Callable
+
+
+log = logging.getLogger(__file__)
+
+
+class _Flight:
+    """ A load in progress."""
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+
+class StateCache:
+    """ Values by key with a time to live (seconds, 0 disables caching)."""
+
+    def __init__(self, ttl:float=3):
+        """ Sets the time to live."""
+        self.ttl = ttl
+        self.entries = dict()
+        self.flights = dict()
+        self.stale = set()
+        self.mutex = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def get(self, key, load:Callable[[], Any]):
+        """ Gets the value, loads it if missing or expired."""
+        with self.mutex:
+            entry = self.entries.get(key)
+            if entry is not None and self._fresh(entry[0]):
+                self.hits += 1
+                return entry[1]
+            flight = self.flights.get(key)
+            owner = flight is None
+            if owner:
+                flight = self.flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.shared += 1
+        if not owner:
+            flight.done.wait()
+            if flight.error is not None: raise flight.error
+            return flight.value
+        try:
+            flight.value = load()
+            with self.mutex:
+                self.entries[key] = (time.monotonic(), flight.value)
+                self.stale.discard(key)
+            return flight.value
+        except Exception as e:
+            with self.mutex:
+                entry = self.entries.get(key)
+                if entry is not None: self.stale.add(key)
+            if entry is None:
+                flight.error = e
+                raise
+            log.warning(f"Serving stale '{key}': {e}")
+            flight.value = entry[1]
+            return flight.value
+        finally:
+            with self.mutex: del self.flights[key]
+            flight.done.set()
+
+    def update(self, key, change:Callable[[Any], None]):
+        """ Changes a cached value in place (write-through)."""
+        with self.mutex:
+            entry = self.entries.get(key)
+            if entry is not None: change(entry[1])
+
+    def invalidate(self, key=None):
+        """ Expires a single or all values (kept as fallback)."""
+        with self.mutex:
+            for k in list(self.entries.keys()) if key is None else [key]:
+                if k in self.entries: self.entries[k] = (None, self.entries[k][1])
+
+    def is_stale(self, key) -> bool:
+        """ Checks whether the value was served after a failed load."""
+        with self.mutex: return key in self.stale
+
+    def stats(self) -> dict:
+        """ Hit and miss counters."""
+        with self.mutex:
+            return {
+                "hits":    self.hits,
+                "misses":  self.misses,
+                "shared":  self.shared,
+                "entries": len(self.entries),
+                "stale":   len(self.stale),
+            }
+
+    def _fresh(self, timestamp:float) -> bool:
+        """ Checks whether an entry is still valid."""
+        return timestamp is not None and time.monotonic() - timestamp < self.ttl
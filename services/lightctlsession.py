@@ -0,0 +1,142 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+"""
+Long-lived lightctl co-process. Commands are written line by line to stdin,
+every answer on stdout is terminated by a marker line ('.' on success,
+'! <message>' on failure).
+"""
+
+import logging
+import subprocess
+from threading import Lock, Timer
+
+
+log = logging.getLogger(__file__)
+
+
+END_OK  = "."
+END_ERR = "!"
+
+
+class SessionError(Exception):
+    """ The session broke down, the command was not processed."""
+
+
+class CommandError(Exception):
+    """ The command was processed but failed."""
+
+
+class Session:
+    """ A lightctl process fed with commands over a pipe."""
+
+    def __init__(self, executable:str, max_failures:int=3, timeout:float=10):
+        """ Sets the executable, the process is started lazily. Answers
+        have to arrive within the timeout (seconds)."""
+        self.executable = executable
+        self.max_failures = max_failures
+        self.timeout = timeout
+        self.failures = 0
+        self.process = None
+        self.expired = False
+        self.mutex = Lock()
+
+    def usable(self) -> bool:
+        """ Checks whether the session should still be used."""
+        return self.failures < self.max_failures
+
+    def exec(self, cmd:str) -> str:
+        """ Sends a command and waits for the answer."""
+        return self.exec_many([cmd])[0]
+
+    def exec_many(self, cmds:list[str], window:int=32) -> list[str]:
+        """ Sends the commands pipelined (without waiting for the single
+        answers) and collects the answers in order. The window limits the
+        unanswered commands, so neither pipe can fill up."""
+        with self.mutex:
+            timer = None
+            try:
+                self._start()
+                # a hanging lightctl is killed, the pending read ends
+                self.expired = False
+                timer = Timer(self.timeout, self._expire, [self.process])
+                timer.start()
+                results = []
+                error = None
+                for idx in range(0, len(cmds), window):
+                    chunk = cmds[idx:idx + window]
+                    for cmd in chunk: self._write(cmd)
+                    for _ in chunk:
+                        # all answers have to be read to stay in sync
+                        try: results.append(self._read())
+                        except CommandError as e:
+                            results.append(None)
+                            error = error or e
+                self.failures = 0
+            except (OSError, ValueError) as e:
+                # a slow bridge does not break the session, it is restarted
+                if self.expired:
+                    self._stop()
+                    raise TimeoutError(
+                        f"lightctl session: no answer within {self.timeout} s")
+                self._fail()
+                raise SessionError(f"lightctl session failed: {e}")
+            finally:
+                if timer is not None: timer.cancel()
+        if error is not None: raise error
+        return results
+
+    def close(self):
+        """ Terminates the co-process."""
+        with self.mutex: self._stop()
+
+    def _start(self):
+        """ Starts the co-process if it is not running."""
+        if self.process is not None and self.process.poll() is None: return
+        if not self.usable(): raise SessionError("lightctl session disabled")
+        log.info("Starting lightctl session.")
+        # 'exec' replaces the shell, only lightctl stays alive
+        self.process = subprocess.Popen(
+            f"exec {self.executable} session", shell = True,
+            stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+            text = True, bufsize = 1)
+
+    def _write(self, cmd:str):
+        """ Writes a single command."""
+        self.process.stdin.write(f"{cmd.strip()}\n")
+        self.process.stdin.flush()
+
+    def _read(self) -> str:
+        """ Reads the answer up to the marker line."""
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if line == "": raise OSError("lightctl session ended")
+            marker = line.rstrip("\n")
+            if marker == END_OK: return "".join(lines)
+            if marker.startswith(END_ERR):
+                raise CommandError(marker[len(END_ERR):].strip())
+            lines.append(line)
+
+    def _expire(self, process:subprocess.Popen):
+        """ Kills the co-process missing the deadline."""
+        log.warning(f"lightctl session: no answer within {self.timeout} s.")
+        self.expired = True
+        process.kill()
+
+    def _fail(self):
+        """ Drops the broken co-process."""
+        self.failures += 1
+        self._stop()
+        if not self.usable():
+            log.warning("lightctl session disabled, falling back to one-shot calls.")
+
+    def _stop(self):
+        """ Stops the co-process."""
+        if self.process is None: return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout = 1)
+        except Exception: self.process.kill()
+        self.process.stdout.close()
+        self.process = None
@@ -2,155 +2,423 @@
 # Distributed under terms of the GPL3 license.
 
 """
-Call lightctl to set device states (such as hue or brightness).
+Call lightctl (or the bridge) to set device states (such as hue or
+brightness).
 """
 
 import logging
-import subprocess
 import time
 import copy
+from concurrent.futures import Future
+from threading import Lock
+from services.lightbackends import Backend
+from services.lightcache import StateCache
+from services.lightdispatch import Dispatcher, gather
+from services.lightgroups import Aggregates
+from services.lightshared import SharedSnapshot
+import services.lightmetrics as lm
 from services.lightstates import State, States, Group
 
 
 log = logging.getLogger(__file__)
-executable = None
+backend = None
+cache = StateCache()
+shared = None
+dispatcher = None
+known = dict()
+known_times = dict()
+known_mutex = Lock()
+aggregates = None
+aggregates_mutex = Lock()
+suppressed = 0
+
+
+def init(
+    configured_backend:Backend,
+    cache_ttl:float=3,
+    workers:int=4,
+    per_bridge:int=2,
+    rate:float=0,
+    shared_snapshot:SharedSnapshot=None):
+    """ Sets the backend (lightctl or bridge REST API) and optionally the
+    snapshot shared with the other worker processes."""
+    global backend
+    global cache
+    global shared
+    global dispatcher
+    global aggregates
+    if dispatcher is not None: dispatcher.close()
+    if backend is not None: backend.close()
+    backend = configured_backend
+    shared = shared_snapshot
+    # the shared snapshot is checked at least every second
+    cache = StateCache(cache_ttl if shared is None else min(cache_ttl, 1))
+    with known_mutex:
+        known.clear()
+        known_times.clear()
+    with aggregates_mutex: aggregates = None
+    dispatcher = Dispatcher(_send, workers, per_bridge, rate=rate)
 
 
-def init(configured_executable):
-    """ Wraps the lightctl executable."""
-    global executable
-    executable = configured_executable
+def exec(cmd, type = "dev", parameters = "", brief = True) -> str:
+    """ Executes the wrapped LightCtl command (lightctl backend only)."""
+    with lm.measure(_kind(cmd, type)):
+        return backend.exec(cmd, type, parameters, brief)
 
 
-def exec(cmd, type = "dev", parameters = "", brief = True) -> str:
-    """ Executes the wrapped LightCtl command."""
-    if type == "grp":    cmd += "-group"
-    if parameters != "": cmd += " " + parameters
-    log.debug(cmd)
-    result = subprocess.check_output(
-        f"{executable} {cmd} {'--brief' if brief else ''}", shell = True) \
-        .decode("utf-8")
-    return result
+def _kind(cmd:str, type:str) -> str:
+    """ Command type for the metrics."""
+    return f"{cmd}-group" if type == "grp" else cmd
 
 
 def state(type, id) -> State:
     """ Gets the state of the device or group."""
-    return State(exec("state", type, id))
+    state = _snapshot(type).get(str(id))
+    if state is None:
+        with lm.measure(_kind("state", type)): return backend.read(type, id)[0]
+    return copy.copy(state)
 
 
 def states(groups:True=False) -> list[State]:
     """ Gets the states."""
     type = "grp" if groups else "dev"
-    return States(exec(f"state", type)).items
-
-
-def set_attributes(ids:list[str], attr:str, val:str):
-    """ Sets an attribute of a device or group."""
+    return [copy.copy(s) for s in _snapshot(type).values()]
+
+
+def _snapshot(type) -> dict[str, State]:
+    """ Gets the cached device or group states by ID. Concurrent callers
+    share a single backend call."""
+    def _read():
+        with lm.measure(_kind("state", type)):
+            return {s.id: s for s in backend.read(type)}
+    def _load():
+        states = _read() if shared is None else shared.get(type, _read)
+        if type == "dev":
+            with known_mutex:
+                now = time.monotonic()
+                for s in states.values():
+                    known[s.id] = _values(s)
+                    known_times[s.id] = now
+        return states
+    return cache.get(type, _load)
+
+
+def _aggregates() -> Aggregates:
+    """ Gets the group aggregates of the current snapshots (rebuilt once
+    the snapshots are reloaded)."""
+    global aggregates
+    devices, groups = _snapshot("dev"), _snapshot("grp")
+    with aggregates_mutex:
+        if aggregates is None or aggregates.devices is not devices \
+            or aggregates.groups is not groups:
+            aggregates = Aggregates(groups, devices)
+        return aggregates
+
+
+def _states(type) -> States:
+    """ Gets the states as indexed container."""
+    return States.of(states(type == "grp"))
+
+
+def stale() -> bool:
+    """ Checks whether the last states had to be served instead of
+    reading the bridge (unavailable)."""
+    return cache.is_stale("dev") or cache.is_stale("grp")
+
+
+def cache_stats() -> dict:
+    """ Gets the cache counters."""
+    if shared is None: return cache.stats()
+    return {**cache.stats(), **shared.stats()}
+
+
+def dispatch_stats() -> dict:
+    """ Gets the write queue depth and counters."""
+    return {**dispatcher.stats(), "suppressed": suppressed}
+
+
+def set_attributes(ids:list[str], attr:str, val:str,
+    origin:str="interactive") -> Future:
+    """ Sets an attribute of devices. The current states are taken from a
+    single snapshot, the new states are submitted together."""
+    _check_attribute(attr, val)
+    snapshot = _snapshot("dev")
+    batch = []
+    for id in ids:
+        s = snapshot.get(str(id))
+        s = copy.copy(s) if s is not None else state("dev", id)
+        _set_attribute(s, attr, val)
+        batch.append(s)
+    return set_batch(batch, origin)
+
+
+def set_group_attribute(id:str, attr:str, val:str,
+    origin:str="interactive") -> Future:
+    """ Sets an attribute of a group with a single group command. Only the
+    changed attribute is sent, the cached member states are updated."""
+    _check_attribute(attr, val)
+    group = state("grp", id)
+    s = State.of(group.id, group.pwr, "-", "-", "-", group.name, group.memids)
+    _set_attribute(s, attr, val)
+    members = [State.of(m, s.pwr, s.hue, s.sat, s.bri) for m in group.memids]
+    if len(_changing(members, False)) == 0:
+        return gather([])
+    future = dispatcher.submit(f"grp-{group.id}", [s],
+        backend.bridge(group.id), origin=origin)
+    lm.count()
+    lm.count_origin(origin, 1)
+    return _track(members, [future])
+
+
+def _check_attribute(attr:str, val:str):
+    """ Checks attribute and value."""
     if attr not in ["pwr", "hue", "sat", "bri"]:
         raise Exception("Invalid attribute")
-    for id in ids:
-        state = State(exec("state", 'dev', id))
-        if attr == "pwr":
-            if val != "on" and val != "off": raise Exception("Invalid value")
-            setattr(state, "pwr", val)
-        else:
-            pwr = "off" if attr == "bri" and int(val) < 1 else "on"
-            setattr(state, attr, int(val))
-            setattr(state, "pwr", pwr)
-        exec("set", type, state.str())
-
-
-def set_state(state:State):
-    """ Sets the state."""
-    exec("set", "", state.str())
+    if attr == "pwr" and val != "on" and val != "off":
+        raise Exception("Invalid value")
+
+
+def _set_attribute(state:State, attr:str, val:str):
+    """ Sets the attribute, the power is turned on (or off for bri 0)."""
+    if attr == "pwr":
+        setattr(state, "pwr", val)
+    else:
+        pwr = "off" if attr == "bri" and int(val) < 1 else "on"
+        setattr(state, attr, int(val))
+        setattr(state, "pwr", pwr)
 
 
-def set_states(states:list[State], ids:set[str]):
+def set_state(state:State, origin:str="interactive", force:bool=False) \
+    -> Future:
+    """ Sets the state."""
+    return set_batch([state], origin, force)
+
+
+def set_batch(
+    states:list[State],
+    origin:str="interactive",
+    force:bool=False) -> Future:
+    """ Sets the states. The devices are written concurrently by the
+    dispatcher, the order per device is kept (e.g. power on, then set).
+    Pending writes of a device are replaced (last writer wins). The origin
+    ('interactive', 'alarm' or 'ambient/<id>') sets the priority. States
+    not changing the known device state are skipped (unless forced). The
+    returned future completes once all states are sent."""
+    if not force: states = _changing(states)
+    states_by_id = dict()
+    for s in states: states_by_id.setdefault(str(s.id), []).append(s)
+    futures = [dispatcher.submit(f"dev-{id}", states_dev,
+            backend.bridge(id), origin=origin) \
+        for id, states_dev in states_by_id.items()]
+    lm.count(len(futures))
+    lm.count_origin(origin, len(states))
+    return _track(states, futures)
+
+
+def _track(states:list[State], futures:list[Future]) -> Future:
+    """ Applies the written device states to cache and known states. If
+    the write fails, the states read before are restored (the cache serves
+    them while the bridge is unavailable)."""
+    previous = dict()
+    written = dict()
+    def _apply(cached):
+        for s in states:
+            old = cached.get(str(s.id))
+            if old is not None: previous.setdefault(old.id, (cached, old))
+            _write_through(cached, s)
+            if old is not None: written[old.id] = cached[old.id]
+    def _apply_shared(stored):
+        for s in states: _write_through(stored, s)
+    def _restore(cached):
+        for id, (dict_old, old) in previous.items():
+            # a reloaded or newer written state is kept
+            if dict_old is cached and cached.get(id) is written[id]:
+                cached[id] = old
+    def _restore_shared(stored):
+        for id, (_, old) in previous.items():
+            if id in stored and _values(stored[id]) == _values(written[id]):
+                stored[id] = old
+    cache.update("dev", _apply)
+    if shared is not None:
+        shared.update("dev", [s.id for s in states], _apply_shared)
+    current = aggregates
+    if current is not None:
+        for s in states: current.refresh(s.id)
+    with known_mutex:
+        now = time.monotonic()
+        for s in states:
+            if str(s.id) in known:
+                known[str(s.id)] = _merge(known[str(s.id)], s)
+                known_times[str(s.id)] = now
+    def _check(done:Future):
+        # the cached states are unreliable after a failed write
+        if done.exception() is not None:
+            cache.update("dev", _restore)
+            cache.invalidate("dev")
+            current = aggregates
+            if current is not None:
+                for id in previous: current.refresh(id)
+            if shared is not None:
+                shared.update("dev", list(previous.keys()), _restore_shared)
+                shared.invalidate("dev")
+            with known_mutex:
+                known.clear()
+                known_times.clear()
+    done = gather(futures)
+    done.add_done_callback(_check)
+    return done
+
+
+def _values(state:State) -> tuple:
+    """ The values a write can change."""
+    return (state.pwr, str(state.hue), str(state.sat), str(state.bri))
+
+
+def _merge(values:tuple, state:State) -> tuple:
+    """ Applies a state to known values ('-' keeps the value)."""
+    return tuple(old if old == "-" or new == "-" else new \
+        for old, new in zip(values, _values(state)))
+
+
+def _changing(states:list[State], count:bool=True) -> list[State]:
+    """ Filters the states that would not change the known device
+    state (applied in order, unknown devices are always written). Known
+    states expire with the cache, the device may have been changed
+    elsewhere (app, wall switch)."""
+    global suppressed
+    changing = []
+    with known_mutex:
+        now = time.monotonic()
+        for id in [i for i, t in known_times.items() if now - t >= cache.ttl]:
+            known.pop(id, None)
+            known_times.pop(id, None)
+        simulated = dict()
+        for s in states:
+            id = str(s.id)
+            values = simulated.get(id, known.get(id))
+            if values is not None:
+                if _merge(values, s) == values:
+                    if count: suppressed += 1
+                    continue
+                simulated[id] = _merge(values, s)
+            changing.append(s)
+    return changing
+
+
+def _send(bridge:str, states:list[State]):
+    """ Sends the states (dispatcher workers), consecutive device or group
+    states with a single round-trip."""
+    runs = []
+    for s in states:
+        if len(runs) > 0 and runs[-1][0].group == s.group: runs[-1].append(s)
+        else: runs.append([s])
+    for run in runs:
+        type = "grp" if run[0].group else "dev"
+        with lm.measure(_kind("set", type)): backend.write(run, type)
+
+
+def _write_through(states:dict[str, State], state:State):
+    """ Applies a written state to the cached states. Unset values ('-')
+    and attributes the device does not support are kept."""
+    old = states.get(str(state.id))
+    if old is None: return
+    def _value(attr):
+        value_old, value_new = getattr(old, attr), getattr(state, attr)
+        return value_old if value_old == "-" or value_new == "-" \
+            else value_new
+    states[old.id] = State(
+        f"{old.id} {state.pwr} {_value('hue')} {_value('sat')} "
+        f"{_value('bri')} {old.name}")
+
+
+def set_states(states:list[State], ids:set[str],
+    origin:str="interactive") -> Future:
     """ Sets the states."""
+    batch = []
     for s in states:
         if s.id not in ids: continue
         s_on = copy.deepcopy(s)
         s_on.pwr = "on"
-        set_state(s_on)
-        set_state(s)
+        batch += [s_on, s]
+    return set_batch(batch, origin)
 
 
 def get_ids_in_group(group_id):
     """ Gets the IDs of group members."""
-    ids = State(exec("state", "grp", group_id)).memids
+    ids = state("grp", group_id).memids
     return ids
 
 
-def set_all_off():
+def set_all_off() -> Future:
     """ Turns all lights off."""
-    states = States(exec("state")).items
-    for s in states:
+    batch = []
+    for s in states():
         if s.pwr == "off": continue
         s.pwr = "off"
-        exec("set", "", s.str())
+        batch.append(s)
+    return set_batch(batch)
 
 
 def states_grouped(type:str) -> list[Group]:
     """ Gets the device or group states."""
     groups = list()
 
-    states_dev = States(exec("state", "dev"))
-
     if type == "grp":
-    
-        states_grp = States(exec("state", "grp"))
-
-        for state_grp in sorted(states_grp.items, key=lambda g: g.name):
-
-            states_mem = states_dev.get_subset(
-                lambda s: (s.id in state_grp.memids))
-
-            for attr in ["bri", "sat", "hue"]:
 
-                values = [s.__dict__[attr] for s in states_mem.items]
-                values = [int(v) for v in values if v != None and v != "-"]
+        current = _aggregates()
+        states_dev = States.of([copy.copy(s) for s in current.devices.values()])
+        states_grp = States.of(current.get())
 
-                value = "-" if len(values) == 0 \
-                            else str(int(sum(values) / len(values)))
-
-                state_grp.__dict__[attr] = value
-
-            state_grp.has_sat = any(m.has_sat for m in states_mem.items)
-            state_grp.has_hue = any(m.has_hue for m in states_mem.items)
-
-            state_grp.pwr = "on" \
-                if any(m.pwr == "on" for m in states_mem.items) \
-                else "off"
-            
-            groups.append(Group(state_grp, states_mem))
+        for head in sorted(states_grp.items, key=lambda g: g.name):
+            groups.append(Group(head, states_dev.subset(states_grp.members(head.id))))
 
     else:
         head = dict()
         head["name"] = ""
-        groups.append(Group(head, states_dev))
+        groups.append(Group(head, _states("dev")))
     
     return groups
 
 
 def blink(names:list[str]):
-    """ Lets the devices blink after a delay."""
-    states = States(exec("state")).items
-    for state in states:
-        if state.name not in names: continue
-        for _ in range(3):
-            # set alarm state temporarily
-            pwr = state.pwr
-            state_alarm = copy.deepcopy(state)
-            state_alarm.pwr = "on"
-            state_alarm.sat = 100
-            state_alarm.bri = 100
-            state_alarm.hue = 0
-            set_state(state_alarm)
-            time.sleep(1)
-            # reset device (pwr needs to be on)
-            state.pwr = "on"
-            set_state(state)
-            time.sleep(0.1)
-            state.pwr = pwr
-            set_state(state)
-
+    """ Lets the devices blink after a delay. All devices change together
+    (frames: alarm state, restored state with power on, power off)."""
+    selected = _states("dev").named(names)
+    if len(selected) == 0: return
+    frame_alarm = []
+    frame_restore = []
+    frame_off = []
+    for state in selected:
+        state_alarm = copy.copy(state)
+        state_alarm.pwr = "on"
+        state_alarm.sat = 100
+        state_alarm.bri = 100
+        state_alarm.hue = 0
+        frame_alarm.append(state_alarm)
+        # reset device (pwr needs to be on)
+        state_on = copy.copy(state)
+        state_on.pwr = "on"
+        frame_restore.append(state_on)
+        if state.pwr == "off": frame_off.append(state)
+    for _ in range(3):
+        _set_frame(frame_alarm).result()
+        time.sleep(1)
+        _set_frame(frame_restore).result()
+        time.sleep(0.1)
+        _set_frame(frame_off).result()
+
+
+def _set_frame(states:list[State]) -> Future:
+    """ Sets the states of a frame with a single round-trip per bridge
+    (not split into device writes). The frame is sent after the pending
+    writes of its devices, later writes wait for it. Alarm writes are not
+    held back by the rate budget, a big frame may exceed the bridge rate."""
+    states_by_bridge = dict()
+    for s in states:
+        states_by_bridge.setdefault(backend.bridge(s.id), []).append(s)
+    futures = [dispatcher.submit([f"dev-{s.id}" for s in states_bridge],
+            states_bridge, bridge, merge=False, origin="alarm") \
+        for bridge, states_bridge in states_by_bridge.items()]
+    lm.count(len(futures))
+    lm.count_origin("alarm", len(states))
+    return _track(states, futures)
@@ -0,0 +1,300 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+"""
+Dispatches device writes to a bounded pool of workers. Writes to different
+devices run concurrently, writes to the same device keep their order. A
+pending write is replaced by a newer write of the same device (last writer
+wins), the commands sent per bridge are limited by a rate budget (alarms
+are exempt). Writes are prioritized by origin (interactive, alarm,
+ambient), running ambients take turns.
+"""
+
+import logging
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+from typing import Callable, Union
+
+
+log = logging.getLogger(__file__)
+lanes = ["interactive", "alarm", "ambient"]
+
+
+class _Write:
+    """ Pending states of a single device (or several devices)."""
+
+    def __init__(self, keys:list[str], bridge:str, states:list, merge:bool,
+            origin:str):
+        self.keys = keys
+        # devices whose earlier writes are not sent yet
+        self.waiting = len(keys)
+        self.bridge = bridge
+        self.states = states
+        self.merge = merge
+        self.future = Future()
+        self.set_origin(origin)
+
+    def set_origin(self, origin:str):
+        """ Sets lane and source ('ambient/<id>' for a running ambient)."""
+        lane, _, self.source = origin.partition("/")
+        if lane not in lanes: raise Exception(f"Unknown origin '{origin}'")
+        self.lane = lane
+        self.priority = lanes.index(lane)
+
+
+class _Budget:
+    """ Token bucket (commands per second)."""
+
+    def __init__(self, rate:float):
+        """ Sets the rate, bursts of up to a second are allowed."""
+        self.rate = rate
+        self.tokens = max(1, rate)
+        self.time = time.monotonic()
+
+    def available(self) -> bool:
+        """ Checks whether a command can be sent."""
+        if self.rate <= 0: return True
+        now = time.monotonic()
+        self.tokens = min(max(1, self.rate),
+            self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        return self.tokens >= 1
+
+    def take(self, commands:int):
+        """ Consumes the tokens (may become negative for big writes)."""
+        if self.rate > 0: self.tokens -= commands
+
+    def delay(self) -> float:
+        """ Seconds until a command can be sent."""
+        return max(0, (1 - self.tokens) / self.rate) if self.rate > 0 else 0
+
+
+class Dispatcher:
+    """ Sends writes with a bounded number of workers and a cap of in-flight
+    writes per bridge. A worker takes up to 'batch' ready writes of a bridge
+    and sends them together. The commands per bridge and second are limited
+    by 'rate' (0: unlimited). Ready writes are taken by priority (lane) and
+    least recently served source; ambient writes leave one in-flight slot
+    per bridge free for the other lanes."""
+
+    def __init__(self,
+            send:Callable[[str, list], None],
+            workers:int=4,
+            per_bridge:int=2,
+            batch:int=8,
+            rate:float=0):
+        """ Sets the send function (bridge, states) and the limits."""
+        self.send = send
+        self.workers = workers
+        self.per_bridge = per_bridge
+        self.batch = batch
+        self.rate = rate
+        self.queues = defaultdict(deque)
+        self.ready = deque()
+        self.busy = set()
+        self.inflight = defaultdict(int)
+        self.budgets = dict()
+        self.served = dict()
+        self.tick = 0
+        self.cond = Condition()
+        self.threads = []
+        self.closed = False
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def submit(self, key:Union[str, list[str]], states:list, bridge:str="",
+            merge:bool=True, origin:str="interactive") -> Future:
+        """ Queues the states of a device, the future completes once they
+        are sent. A mergeable write replaces the pending mergeable write of
+        the device, both callers get the same future. The first pending
+        write of the device inherits a higher priority. A write of several
+        devices (list of keys, not mergeable) is sent with a single
+        round-trip after the earlier writes of all its devices, later
+        writes of these devices wait for it."""
+        if not isinstance(key, str):
+            return self._submit_all(list(dict.fromkeys(key)), states, bridge,
+                origin)
+        with self.cond:
+            if self.closed: raise Exception("Dispatcher closed")
+            self._start()
+            queue = self.queues[key]
+            if merge and len(queue) > 0 and queue[-1].merge:
+                pending = queue[-1]
+                self.merged += 1
+                self.dropped += len(pending.states)
+                priority = pending.priority
+                pending.states = states
+                pending.set_origin(origin)
+                pending.priority = min(priority, pending.priority)
+                write = pending
+            else:
+                write = _Write([key], bridge, states, merge, origin)
+                queue.append(write)
+                if len(queue) == 1 and key not in self.busy: self._arrive(key)
+            queue[0].priority = min(queue[0].priority, write.priority)
+            self.cond.notify()
+        return write.future
+
+    def _submit_all(self, keys:list[str], states:list, bridge:str,
+            origin:str) -> Future:
+        """ Queues a write of several devices."""
+        with self.cond:
+            if self.closed: raise Exception("Dispatcher closed")
+            self._start()
+            write = _Write(keys, bridge, states, False, origin)
+            for key in keys:
+                queue = self.queues[key]
+                queue.append(write)
+                if len(queue) == 1 and key not in self.busy: self._arrive(key)
+                queue[0].priority = min(queue[0].priority, write.priority)
+            self.cond.notify()
+        return write.future
+
+    def _arrive(self, key:str):
+        """ The first write of the device can be sent (once it can be sent
+        for all of its devices)."""
+        write = self.queues[key][0]
+        write.waiting -= 1
+        if write.waiting == 0: self.ready.append(write.keys[0])
+
+    def _queued(self) -> list[_Write]:
+        """ The writes not yet sent."""
+        return list({id(w): w for q in self.queues.values() for w in q} \
+            .values())
+
+    def pending(self) -> int:
+        """ Number of writes not yet sent."""
+        with self.cond:
+            return len(self._queued())
+
+    def stats(self) -> dict:
+        """ Queue depth and counters."""
+        with self.cond:
+            writes = self._queued()
+            queued = {f"queued {l}": 0 for l in lanes}
+            for w in writes: queued[f"queued {w.lane}"] += 1
+            return {
+                "queued":  len(writes),
+                **queued,
+                "sent":    self.sent,
+                "merged":  self.merged,
+                "dropped": self.dropped,
+            }
+
+    def close(self):
+        """ Stops the workers after the pending writes are sent."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads: t.join()
+
+    def _start(self):
+        """ Starts the workers lazily."""
+        while len(self.threads) < self.workers:
+            thread = Thread(target=self._work, daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def _work(self):
+        """ Worker loop."""
+        while True:
+            with self.cond:
+                writes, delay = self._take()
+                while len(writes) == 0:
+                    if self.closed and len(self.ready) == 0: return
+                    self.cond.wait(delay)
+                    writes, delay = self._take()
+                states = [s for w in writes for s in w.states]
+                self.sent += len(states)
+            bridge = writes[0].bridge
+            try:
+                self.send(bridge, states)
+                error = None
+            except Exception as e:
+                log.error(f"Write to '{bridge}' failed: {e}")
+                error = e
+            with self.cond:
+                self.inflight[bridge] -= 1
+                for w in writes:
+                    for key in w.keys:
+                        self.busy.discard(key)
+                        if len(self.queues[key]) > 0: self._arrive(key)
+                        else: del self.queues[key]
+                self.cond.notify_all()
+            for w in writes:
+                if error is None: w.future.set_result(None)
+                else: w.future.set_exception(error)
+
+    def _take(self) -> tuple[list[_Write], float]:
+        """ Takes ready writes of the first bridge with a free slot and
+        budget. Otherwise, returns the time to wait for the budget."""
+        bridge = None
+        budget = None
+        writes = []
+        delay = None
+        for key in sorted(self.ready, key=self._rank):
+            write = self.queues[key][0]
+            if bridge is None:
+                if self.inflight[write.bridge] >= self._slots(write): continue
+                budget = self._budget(write.bridge)
+                if not self._exempt(write) and not budget.available():
+                    delay = budget.delay() if delay is None \
+                        else min(delay, budget.delay())
+                    continue
+                bridge = write.bridge
+            elif write.bridge != bridge: continue
+            elif not self._exempt(write) and not budget.available(): break
+            self.ready.remove(key)
+            for k in write.keys:
+                self.queues[k].popleft()
+                self.busy.add(k)
+            budget.take(len(write.states))
+            self.tick += 1
+            self.served[write.source] = self.tick
+            writes.append(write)
+            if len(writes) >= self.batch: break
+        if bridge is not None: self.inflight[bridge] += 1
+        return writes, delay
+
+    def _rank(self, key:str) -> tuple:
+        """ Lane first, then the least recently served source."""
+        write = self.queues[key][0]
+        return (write.priority, self.served.get(write.source, 0))
+
+    def _slots(self, write:_Write) -> int:
+        """ In-flight writes allowed, one slot is kept for non-ambients."""
+        if write.lane != "ambient": return self.per_bridge
+        return max(1, self.per_bridge - 1)
+
+    def _exempt(self, write:_Write) -> bool:
+        """ Alarm writes do not wait for the budget, so the frames of a
+        blinking alarm are not spread over seconds. Their commands are
+        still taken from the budget, the other lanes wait instead (the
+        bridge may drop commands of a big alarm burst)."""
+        return write.lane == "alarm"
+
+    def _budget(self, bridge:str) -> _Budget:
+        """ Gets the budget of the bridge."""
+        if bridge not in self.budgets: self.budgets[bridge] = _Budget(self.rate)
+        return self.budgets[bridge]
+
+
+def gather(futures:list[Future]) -> Future:
+    """ Combines futures, the result is the first error (if any)."""
+    combined = Future()
+    futures = list(futures)
+    remaining = [len(futures)]
+    mutex = Lock()
+    if len(futures) == 0: combined.set_result(None)
+    def _done(_):
+        with mutex:
+            remaining[0] -= 1
+            if remaining[0] > 0: return
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if len(errors) > 0: combined.set_exception(errors[0])
+        else: combined.set_result(None)
+    for f in futures: f.add_done_callback(_done)
+    return combined
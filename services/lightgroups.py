@@ -0,0 +1,86 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+"""
+Aggregates the group states (average brightness, saturation and hue, power)
+from the member devices. Built once per snapshot, a changed device only
+updates the groups it belongs to.
+"""
+
+import copy
+from threading import Lock
+from services.lightstates import State
+
+
+attrs = ["bri", "sat", "hue"]
+
+
+class Aggregates:
+    """ Group heads of a device and group snapshot."""
+
+    def __init__(self, groups:dict[str, State], devices:dict[str, State]):
+        """ Aggregates all groups."""
+        self.groups = groups
+        self.devices = devices
+        self.mutex = Lock()
+        self.owners = dict()
+        self.parts = dict()
+        self.totals = dict()
+        self.heads = dict()
+        for g in groups.values():
+            self.totals[g.id] = [0] * (3 + 2 * len(attrs))
+            for m in dict.fromkeys(g.memids):
+                self.owners.setdefault(m, []).append(g.id)
+        for id in self.owners:
+            device = devices.get(id)
+            if device is None: continue
+            self.parts[id] = _part(device)
+            for g in self.owners[id]: _add(self.totals[g], self.parts[id], 1)
+        for g in groups.values(): self.heads[g.id] = self._head(g)
+
+    def refresh(self, id:str):
+        """ Updates the groups of a changed device."""
+        device = self.devices.get(str(id))
+        if device is None or str(id) not in self.owners: return
+        part = _part(device)
+        with self.mutex:
+            old = self.parts.get(device.id)
+            if old == part: return
+            self.parts[device.id] = part
+            for g in self.owners[device.id]:
+                if old is not None: _add(self.totals[g], old, -1)
+                _add(self.totals[g], part, 1)
+                self.heads[g] = self._head(self.groups[g])
+
+    def get(self) -> list[State]:
+        """ Gets copies of the group heads."""
+        with self.mutex:
+            return [copy.copy(h) for h in self.heads.values()]
+
+    def _head(self, group:State) -> State:
+        """ Group state with the aggregated values."""
+        on, has_hue, has_sat, *sums = self.totals[group.id]
+        head = copy.copy(group)
+        for idx, attr in enumerate(attrs):
+            total, count = sums[2 * idx], sums[2 * idx + 1]
+            setattr(head, attr, "-" if count == 0 else str(int(total / count)))
+        head.has_hue = has_hue > 0
+        head.has_sat = has_sat > 0
+        head.pwr = "on" if on > 0 else "off"
+        return head
+
+
+def _part(device:State) -> tuple:
+    """ Contribution of a device (power, hue/sat support, sums and
+    counts)."""
+    part = [int(device.pwr == "on"), int(device.has_hue), int(device.has_sat)]
+    for attr in attrs:
+        value = getattr(device, attr)
+        if value is None or value == "-": part += [0, 0]
+        else: part += [int(value), 1]
+    return tuple(part)
+
+
+def _add(totals:list, part:tuple, sign:int):
+    """ Adds or removes a contribution."""
+    for idx, value in enumerate(part): totals[idx] += sign * value
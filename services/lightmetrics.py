@@ -0,0 +1,109 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+"""
+Measures the bridge calls: latency histograms, errors and in-flight calls by
+command type, calls per HTTP request and writes per lane.
+"""
+
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from threading import Lock
+
+from flask import g, has_request_context, request
+
+
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float("inf")]
+mutex = Lock()
+histograms = defaultdict(lambda: [0] * len(buckets))
+totals = defaultdict(float)
+errors = defaultdict(int)
+inflight = defaultdict(int)
+origins = defaultdict(int)
+requests = deque(maxlen=20)
+
+
+@contextmanager
+def measure(kind:str):
+    """ Measures a call (e.g. 'state', 'set-group')."""
+    count()
+    with mutex: inflight[kind] += 1
+    start = time.monotonic()
+    try:
+        yield
+    except Exception:
+        with mutex: errors[kind] += 1
+        raise
+    finally:
+        seconds = time.monotonic() - start
+        with mutex:
+            inflight[kind] -= 1
+            totals[kind] += seconds
+            histogram = histograms[kind]
+            for idx, limit in enumerate(buckets):
+                if seconds <= limit:
+                    histogram[idx] += 1
+                    break
+
+
+def count(calls:int=1):
+    """ Counts calls caused by the current HTTP request."""
+    if not has_request_context(): return
+    g.lightctl_calls = g.get("lightctl_calls", 0) + calls
+
+
+def count_origin(origin:str, writes:int):
+    """ Counts the device writes by lane (an ambient run is not kept apart,
+    the run IDs would grow the counters without bound)."""
+    lane = origin.partition("/")[0]
+    with mutex: origins[lane] += writes
+
+
+def finish_request():
+    """ Records the calls of the finished HTTP request."""
+    if not has_request_context(): return
+    calls = g.get("lightctl_calls", 0)
+    if calls > 0:
+        with mutex: requests.append((request.path, calls))
+
+
+def report() -> str:
+    """ Latencies, calls per request and writes per lane as text."""
+    with mutex:
+        lines = []
+        for kind in sorted(histograms.keys()):
+            histogram = histograms[kind]
+            calls = sum(histogram)
+            avg = totals[kind] / calls * 1000 if calls > 0 else 0
+            lines.append(
+                f"{kind}: {calls} calls, {errors[kind]} errors, "
+                f"{inflight[kind]} in flight, avg {avg:.1f} ms, "
+                f"p50 <= {_percentile(histogram, 0.5)}, "
+                f"p95 <= {_percentile(histogram, 0.95)}")
+            lines.append("  " + " ".join(
+                [f"{_limit(b)}:{c}" for b, c in zip(buckets, histogram) if c > 0]))
+        lines.append("")
+        lines.append("calls per request (latest)")
+        lines += [f"  {calls:4} {path}" for path, calls in reversed(requests)]
+        lines.append("")
+        lines.append("writes per lane")
+        lines += [f"  {writes:6} {origin}" \
+            for origin, writes in sorted(origins.items())]
+        return "\n".join(lines)
+
+
+def _percentile(histogram:list, share:float) -> str:
+    """ Upper bucket limit of the percentile."""
+    calls = sum(histogram)
+    if calls == 0: return "-"
+    seen = 0
+    for limit, c in zip(buckets, histogram):
+        seen += c
+        if seen >= share * calls: return _limit(limit)
+    return _limit(buckets[-1])
+
+
+def _limit(seconds:float) -> str:
+    """ Bucket limit as text."""
+    return "inf" if seconds == float("inf") else f"{seconds * 1000:g}ms"
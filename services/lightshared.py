@@ -0,0 +1,233 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+"""
+Shares the device and group snapshots between the worker processes (SQLite
+tables, a row per device with the version it was changed in). A single
+worker polls the bridge once the snapshot is outdated (lease), the others
+keep reading the stored snapshot. Writes only touch the rows of the written
+devices, workers only read the rows changed since their last read.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable
+from services.lightstates import State
+
+
+log = logging.getLogger(__file__)
+
+
+class SharedSnapshot:
+    """ Snapshots by type ('dev', 'grp') in a database file."""
+
+    def __init__(self, path:str, ttl:float=3, lease:float=10):
+        """ Sets the database file, the time to live of a snapshot and how
+        long a poller may take."""
+        self.path = path
+        self.ttl = ttl
+        self.lease = lease
+        self.mutex = Lock()
+        self.connection = None
+        self.pid = None
+        self.parsed = dict()
+        self.polls = 0
+        self.reads = 0
+        self._execute('''
+            CREATE TABLE IF NOT EXISTS light_types (
+                type TEXT PRIMARY KEY,
+                version INTEGER,
+                polled INTEGER,
+                loaded REAL,
+                lease REAL)''')
+        self._execute('''
+            CREATE TABLE IF NOT EXISTS light_states (
+                type TEXT,
+                id TEXT,
+                version INTEGER,
+                pwr TEXT,
+                hue TEXT,
+                sat TEXT,
+                bri TEXT,
+                name TEXT,
+                memids TEXT,
+                PRIMARY KEY (type, id))''')
+
+    def get(self, type:str, read:Callable[[], dict[str, State]]) \
+        -> dict[str, State]:
+        """ Gets the states by ID. The states are read from the bridge if
+        the snapshot is outdated and no other worker is polling. The same
+        dictionary is returned while the version is unchanged."""
+        self._execute('''
+            INSERT OR IGNORE INTO light_types
+            VALUES (?, 0, 0, 0, 0)''', (type,))
+        waited = 0
+        while True:
+            version, polled, loaded = self._execute('''
+                SELECT version, polled, loaded FROM light_types
+                WHERE type = ?''', (type,))[0]
+            now = time.time()
+            if polled > 0 and now - loaded < self.ttl:
+                return self._parse(type, version)
+            claimed = self._execute('''
+                UPDATE light_types SET lease = ?
+                WHERE type = ? AND version = ? AND lease < ?''',
+                (now + self.lease, type, version, now))
+            if claimed: return self._poll(type, read)
+            # another worker is polling, an outdated snapshot is still fine
+            if polled > 0: return self._parse(type, version)
+            if waited > self.lease: return read()
+            time.sleep(0.05)
+            waited += 0.05
+
+    def update(self, type:str, ids:list[str],
+            change:Callable[[dict[str, State]], None]):
+        """ Changes the stored states of the devices (write-through), the
+        change gets the stored states of these devices only."""
+        ids = list(dict.fromkeys(map(str, ids)))
+        if len(ids) == 0: return
+        with self.mutex:
+            connection = self._connect()
+            with _transaction(connection):
+                version, polled = connection.execute('''
+                    SELECT version, polled FROM light_types
+                    WHERE type = ?''', (type,)).fetchone() or (0, 0)
+                if polled == 0: return
+                states = _states(connection.execute(f'''
+                    SELECT id, pwr, hue, sat, bri, name, memids
+                    FROM light_states WHERE type = ? AND id IN
+                    ({", ".join("?" * len(ids))})''', (type, *ids)))
+                change(states)
+                connection.executemany('''
+                    UPDATE light_states
+                    SET version = ?, pwr = ?, hue = ?, sat = ?, bri = ?
+                    WHERE type = ? AND id = ?''',
+                    [(version + 1, s.pwr, str(s.hue), str(s.sat), str(s.bri),
+                        type, s.id) for s in states.values()])
+                connection.execute('''
+                    UPDATE light_types SET version = ?
+                    WHERE type = ?''', (version + 1, type))
+            # the local states are already changed by the caller
+            parsed = self.parsed.get(type)
+            if parsed is not None and parsed[0] == version:
+                self.parsed[type] = (version + 1, parsed[1], parsed[2])
+
+    def invalidate(self, type:str=None):
+        """ Marks a single or all snapshots as outdated."""
+        if type is None:
+            self._execute("UPDATE light_types SET loaded = 0")
+        else:
+            self._execute('''
+                UPDATE light_types SET loaded = 0
+                WHERE type = ?''', (type,))
+
+    def stats(self) -> dict:
+        """ Polls (bridge reads) and reads of this worker."""
+        return {"polls": self.polls, "reads": self.reads}
+
+    def _poll(self, type:str, read:Callable) -> dict[str, State]:
+        """ Reads the states from the bridge and stores them."""
+        try:
+            states = read()
+        except Exception:
+            self._execute('''
+                UPDATE light_types SET lease = 0
+                WHERE type = ?''', (type,))
+            raise
+        with self.mutex:
+            connection = self._connect()
+            with _transaction(connection):
+                version = connection.execute('''
+                    SELECT version FROM light_types
+                    WHERE type = ?''', (type,)).fetchone()[0] + 1
+                connection.execute('''
+                    DELETE FROM light_states WHERE type = ?''', (type,))
+                connection.executemany('''
+                    INSERT INTO light_states
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                    [(type, s.id, version, s.pwr, str(s.hue), str(s.sat),
+                        str(s.bri), s.name,
+                        json.dumps(s.memids) if s.group else None) \
+                        for s in states.values()])
+                connection.execute('''
+                    UPDATE light_types
+                    SET version = ?, polled = ?, loaded = ?, lease = 0
+                    WHERE type = ?''', (version, version, time.time(), type))
+            self.polls += 1
+            self.parsed[type] = (version, version, states)
+        return states
+
+    def _parse(self, type:str, version:int) -> dict[str, State]:
+        """ Gets the stored states once per version. Only the rows changed
+        since the last read are decoded, unless the bridge was polled."""
+        with self.mutex:
+            self.reads += 1
+            parsed = self.parsed.get(type)
+            if parsed is not None and parsed[0] == version: return parsed[2]
+            connection = self._connect()
+            with _transaction(connection, "BEGIN"):
+                version, polled = connection.execute('''
+                    SELECT version, polled FROM light_types
+                    WHERE type = ?''', (type,)).fetchone()
+                if parsed is not None and parsed[1] == polled:
+                    states = dict(parsed[2])
+                    rows = connection.execute('''
+                        SELECT id, pwr, hue, sat, bri, name, memids
+                        FROM light_states WHERE type = ? AND version > ?''',
+                        (type, parsed[0]))
+                else:
+                    states = dict()
+                    rows = connection.execute('''
+                        SELECT id, pwr, hue, sat, bri, name, memids
+                        FROM light_states WHERE type = ?''', (type,))
+                states.update(_states(rows))
+            self.parsed[type] = (version, polled, states)
+            return states
+
+    def _execute(self, sql:str, data:tuple=()):
+        """ Executes a single statement, rows or changed row count."""
+        with self.mutex:
+            connection = self._connect()
+            cursor = connection.execute(sql, data)
+            try:
+                if sql.lstrip().startswith("SELECT"): return cursor.fetchall()
+                return cursor.rowcount
+            finally: cursor.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        """ Gets the connection of this process (a forked worker opens its
+        own). The snapshot can be read again from the bridge, so commits
+        are not synced to disk."""
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=5,
+                isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.pid = os.getpid()
+            self.parsed.clear()
+        return self.connection
+
+
+@contextmanager
+def _transaction(connection:sqlite3.Connection, begin:str="BEGIN IMMEDIATE"):
+    """ Runs the statements in a transaction (rolled back on errors)."""
+    connection.execute(begin)
+    try:
+        yield
+    except Exception:
+        if connection.in_transaction: connection.execute("ROLLBACK")
+        raise
+    if connection.in_transaction: connection.execute("COMMIT")
+
+
+def _states(rows) -> dict[str, State]:
+    """ States from rows (id, pwr, hue, sat, bri, name, memids)."""
+    states = [State.of(id, pwr, hue, sat, bri, name,
+            None if memids is None else json.loads(memids)) \
+        for id, pwr, hue, sat, bri, name, memids in rows]
+    return {s.id: s for s in states}
@@ -8,27 +8,79 @@ Device states.
 import colorsys
 import json
 import re
-from typing import Any, Callable
+from typing import Any
 
 
 class State:
     """ A single device state (hue, saturation, brightness) with helpful conversions (HSB with max/min saturation, RGB, ...)."""
 
+    __slots__ = ("id", "pwr", "hue", "sat", "bri", "has_hue", "has_sat",
+        "group", "name", "memids", "uid", "_conv", "_conv_key")
+
     def __init__(self, state_str:str):
         """ Parses a state string."""
 
         state_str_split = state_str.split()
-        
-        self.id = state_str_split[0]
-        self.pwr = state_str_split[1]
 
-        self.hue = state_str_split[2]
-        self.sat = state_str_split[3]
-        self.bri = state_str_split[4]
+        # fast path: plain device state (five columns)
+        if len(state_str_split) == 5:
+            self._init(*state_str_split, "", None)
+            return
+
+        # groups have member IDs as last column
+        # (comma-separated list in squared brackets)
+        last_columns = " ".join(state_str_split[5:])
+        name_and_memids = re.search(r"(.*)\[(.*)\]", last_columns) \
+            if last_columns.endswith("]") else None
+
+        if name_and_memids is not None:
+            name = name_and_memids.group(1).strip()
+            memids = [str(i) for i in name_and_memids.group(2).split(",")]
+        else:
+            name = last_columns.strip()
+            memids = None
+
+        self._init(*state_str_split[:5], name, memids)
+
+    @classmethod
+    def of(cls, id, pwr, hue, sat, bri, name="", memids:list=None):
+        """ Creates a state from values (no parsing), '-' for unsupported
+        values, member IDs for groups."""
+        state = cls.__new__(cls)
+        state._init(str(id), pwr, str(hue), str(sat), str(bri), name,
+            None if memids is None else [str(i) for i in memids])
+        return state
+
+    def _init(self, id, pwr, hue, sat, bri, name, memids):
+        """ Sets the values, conversions are computed on first access."""
+
+        self.id = id
+        self.pwr = pwr
+
+        self.hue = hue
+        self.sat = sat
+        self.bri = bri
 
         self.has_hue = self.hue != "-"
         self.has_sat = self.sat != "-"
 
+        self.group = memids is not None
+        self.name = name
+        self._conv_key = None
+
+        if self.group:
+            self.memids = memids
+            self.uid = f'grp-{self.id}'
+        else:
+            self.uid = f'dev-{self.id}'
+
+    def _conversions(self) -> tuple:
+        """ RGB conversions (normal, high and low saturation), memoized
+        until hue, saturation or brightness change."""
+
+        key = (self.hue, self.sat, self.bri)
+        if self._conv_key == key: return self._conv
+
         def conv(value, default): 
             return default if value == "-" else float(value)
         
@@ -36,45 +88,31 @@ class State:
         # 1) single-colored lights have a warm tone
         # 2) the brightness is scaled
 
+        hue = conv(self.hue, 45) / 360
         bri_scaled = (30 + (0.7 * conv(self.bri, 0))) / 100
 
-        self.rgb = colorsys.hsv_to_rgb(
-            conv(self.hue, 45) / 360, 
-            conv(self.sat, 25) / 100, 
-            bri_scaled)
-        
-        self.rgb_hsat = colorsys.hsv_to_rgb(
-            conv(self.hue, 45) / 360, 1.0, bri_scaled)
-        
-        self.rgb_lsat = colorsys.hsv_to_rgb(
-            conv(self.hue, 45) / 360, 0.0, bri_scaled)
+        self._conv = (
+            colorsys.hsv_to_rgb(hue, conv(self.sat, 25) / 100, bri_scaled),
+            colorsys.hsv_to_rgb(hue, 1.0, bri_scaled),
+            colorsys.hsv_to_rgb(hue, 0.0, bri_scaled))
+        self._conv_key = key
+        return self._conv
 
-        self.red = self.rgb[0] * 255
-        self.gre = self.rgb[1] * 255
-        self.blu = self.rgb[2] * 255
+    rgb      = property(lambda self: self._conversions()[0])
+    rgb_hsat = property(lambda self: self._conversions()[1])
+    rgb_lsat = property(lambda self: self._conversions()[2])
 
-        self.red_lsat = self.rgb_lsat[0] * 255
-        self.gre_lsat = self.rgb_lsat[1] * 255
-        self.blu_lsat = self.rgb_lsat[2] * 255
-
-        self.red_hsat = self.rgb_hsat[0] * 255
-        self.gre_hsat = self.rgb_hsat[1] * 255
-        self.blu_hsat = self.rgb_hsat[2] * 255
-        
-        # groups have member IDs as last column
-        # (comma-separated list in squared brackets)
-        last_columns = " ".join(state_str_split[5:])
-        name_and_memids = re.search(r"(.*)\[(.*)\]", last_columns)
+    red = property(lambda self: self.rgb[0] * 255)
+    gre = property(lambda self: self.rgb[1] * 255)
+    blu = property(lambda self: self.rgb[2] * 255)
 
-        self.group = name_and_memids is not None
+    red_lsat = property(lambda self: self.rgb_lsat[0] * 255)
+    gre_lsat = property(lambda self: self.rgb_lsat[1] * 255)
+    blu_lsat = property(lambda self: self.rgb_lsat[2] * 255)
 
-        if self.group:
-            self.name = name_and_memids.group(1).strip()
-            self.memids = [str(i) for i in name_and_memids.group(2).split(",")]
-            self.uid = f'grp-{self.id}'
-        else:
-            self.name = last_columns.strip()
-            self.uid = f'dev-{self.id}'
+    red_hsat = property(lambda self: self.rgb_hsat[0] * 255)
+    gre_hsat = property(lambda self: self.rgb_hsat[1] * 255)
+    blu_hsat = property(lambda self: self.rgb_hsat[2] * 255)
 
     def str(self):
         """ String."""
@@ -82,29 +120,66 @@ class State:
 
     def json(self):
         """ JSON."""
-        return json.dumps(self.__dict__)
+        attrs = ["id", "pwr", "hue", "sat", "bri", "has_hue", "has_sat",
+            "group", "name", "memids", "uid", "rgb", "rgb_hsat", "rgb_lsat"]
+        return json.dumps(
+            {a: getattr(self, a) for a in attrs if hasattr(self, a)})
     
     def set(self, attr, val):
         """ Set attribute."""
-        self.__dict__[attr] = val
+        setattr(self, attr, val)
 
 
 class States:
-    """ Many states."""
+    """ Many states, indexed by ID and name."""
 
     def __init__(self, states_str = ""):
         """ Parses a state string."""
-        self.items = list()
-        for state_str in states_str.split("\n"):
-            if state_str != "":
-                self.items.append(State(state_str))
-
-    def get_subset(self, predicate:Callable):
-        """ Gets a member subset"""
-        state_subset = States()
-        state_subset.items = \
-            list(sorted(filter(predicate, self.items), key=lambda d: d.name))
-        return state_subset
+        self.items = [State(state_str) \
+            for state_str in states_str.split("\n") if state_str != ""]
+
+    @classmethod
+    def of(cls, items:list[State]):
+        """ Creates the container from states."""
+        states = cls()
+        states.items = items
+        return states
+
+    @property
+    def items(self) -> list[State]:
+        """ The states."""
+        return self._items
+
+    @items.setter
+    def items(self, items:list[State]):
+        """ Sets the states and builds the indexes."""
+        self._items = list(items)
+        self._by_id = {s.id: s for s in self._items}
+        self._by_name = dict()
+        for s in self._items: self._by_name.setdefault(s.name, []).append(s)
+        self._memids = None
+
+    def get(self, id) -> State:
+        """ Gets the state by ID (None if unknown)."""
+        return self._by_id.get(str(id))
+
+    def named(self, names:list[str]) -> list[State]:
+        """ Gets the states with the names."""
+        if isinstance(names, str): names = [names]
+        return [s for n in dict.fromkeys(names) for s in self._by_name.get(n, [])]
+
+    def members(self, id) -> frozenset[str]:
+        """ Gets the member IDs of a group (the member sets are built on
+        first use)."""
+        if self._memids is None:
+            self._memids = {s.id: frozenset(s.memids) \
+                for s in self._items if s.group}
+        return self._memids.get(str(id), frozenset())
+
+    def subset(self, ids) -> "States":
+        """ Gets the states with the IDs (sorted by name)."""
+        found = [self._by_id[i] for i in set(map(str, ids)) if i in self._by_id]
+        return States.of(sorted(found, key=lambda d: d.name))
 
 
     def json(self):
@@ -0,0 +1,62 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+"""
+Scenes are captured device states (a line per device: ID PWR HUE SAT BRI
+NAME). A scene is restored with a single batch containing only the devices
+that differ from the current state.
+"""
+
+import logging
+from concurrent.futures import Future
+from services.lightstates import State, States
+
+
+log = logging.getLogger(__file__)
+
+
+def init(fileaccess, lightctlwrapper):
+    """ Sets fileaccess and lightctlwrapper."""
+    global lw
+    global fa
+    lw = lightctlwrapper
+    fa = fileaccess
+
+
+def all() -> list[str]:
+    """ Lists the scenes."""
+    scenes, _ = fa.list_files(["scenes"])
+    return scenes
+
+
+def capture(name:str):
+    """ Stores the current device states as scene."""
+    content = "\n".join([f"{s.str()} {s.name}" for s in lw.states()])
+    fa.update_file(["scenes", name], content + "\n", True)
+
+
+def restore(name:str, origin:str="interactive") -> Future:
+    """ Sets the devices differing from the scene."""
+    scene = States(fa.read_file(["scenes", name])).items
+    current = {s.id: s for s in lw.states()}
+    changed = [s for s in scene if _differs(s, current.get(s.id))]
+    log.info(f"Scene '{name}': {len(changed)} of {len(scene)} devices change.")
+    return lw.set_batch(changed, origin)
+
+
+def delete(name:str):
+    """ Deletes a scene."""
+    fa.delete_file(["scenes", name])
+
+
+def _differs(target:State, current:State) -> bool:
+    """ Checks whether setting the target changes the device (values of
+    switched off devices do not matter)."""
+    if current is None: return True
+    if target.pwr != current.pwr: return True
+    if target.pwr == "off": return False
+    for attr in ["hue", "sat", "bri"]:
+        value_target, value_current = getattr(target, attr), getattr(current, attr)
+        if value_target == "-" or value_current == "-": continue
+        if str(value_target) != str(value_current): return True
+    return False
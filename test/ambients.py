@@ -0,0 +1,48 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+import unittest
+import viewmodels.ambients as ambients
+from services.lightdispatch import gather
+from services.lightstates import State
+
+
+class _Lights:
+    """ Current states, records the written batches."""
+
+    def __init__(self, lines:list[str]):
+        self.current = [State(l) for l in lines]
+        self.batches = []
+
+    def states(self): return self.current
+
+    def set_batch(self, states, origin="interactive"):
+        self.batches.append([s.str() for s in states])
+        return gather([])
+
+
+class Test_ambients(unittest.TestCase):
+    """ Tests the ambients view-model."""
+
+    def setUp(self):
+        self.lights = _Lights([
+            "1 on 40 90 50 Kitchen",
+            "2 on - - 20 Bedroom",
+            "3 off 120 60 100 Desk"])
+        self.lw = ambients.lw
+        ambients.lw = self.lights
+
+    def tearDown(self):
+        ambients.lw = self.lw
+
+
+    def test_set_names(self):
+        """ Comma-separated names select all named devices."""
+        ambients.set("Kitchen,Bedroom", "off")
+        ambients.set(["Desk"], "on", bri=30)
+        self.assertEqual(self.lights.batches,
+            [["1 off - - -", "2 off - - -"], ["3 on - - 30"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
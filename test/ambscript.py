@@ -1,14 +1,55 @@
 # This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
 # Distributed under terms of the GPL3 license.
 
+import os
+import tempfile
+import threading
+import time
 import unittest
 import services.ambinterpreter as ami
+import services.fileaccess as fa
 from services.lightstates import State
 
 
 # TODO: more tests
 
 
+class _Lights:
+    """ Records the states set."""
+
+    def __init__(self, states):
+        self.states = {s.id: s for s in states}
+        self.set = []
+        self.reads = 0
+
+    def state(self, type, id):
+        self.reads += 1
+        return self.states[str(id)]
+
+    def set_state(self, state, origin="interactive"): self.set.append(state.str())
+
+    def set_states(self, states, ids, origin="interactive"): pass
+
+
+class _Files:
+    """ No macros."""
+
+    def share_path(self, parts): return "/nonexistent"
+
+    def list_files(self, path): return [], []
+
+
+class _Tasks:
+    """ Ambients keep running until cleared."""
+
+    def __init__(self): self.cleared = set()
+
+    def get_task_state(self, id):
+        return 'unknown' if id in self.cleared else 'running'
+
+    def clear_tasks(self, ids): self.cleared.update(ids)
+
+
 class Test_ambinterpreter(unittest.TestCase):
     """ Tests the ambscript interpreter."""
 
@@ -21,13 +62,111 @@ class Test_ambinterpreter(unittest.TestCase):
         State("5 on   -      -   52  e"),
     ]
 
+    def setUp(self):
+        self.lights = _Lights(self.states)
+        ami.init(_Files(), _Tasks(), self.lights)
+
 
     def test_asterisk(self):
         """ Test the asterisk (all devices)."""
         changed_ids = set()
-        ami._interpret_tokens(["* on"], self.states, changed_ids)
-        self.assertIs(changed_ids, set([1, 2, 3, 4, 5]))
+        ami._interpret_tokens(1, ami._statements(["* on"]), self.states,
+            changed_ids, {})
+        self.assertEqual(changed_ids, set(["1", "2", "3", "4", "5"]))
+
+
+    def test_compiled(self):
+        """ Lists, repetitions and relative values."""
+        changed_ids = set()
+        context = {"$ids": "1,3", "$up": "+10"}
+        ami._interpret_tokens(1, ami._statements([
+            "repeat 2 $ids on - - $up", "2 on 400 150 -5"]),
+            self.states, changed_ids, context)
+        self.assertEqual(self.lights.set, [
+            "1 on - - 60", "3 on - - 62", "1 on - - 70", "3 on - - 72",
+            "2 on 40 100 95"])
+
+
+    def test_shadow(self):
+        """ Relative values build on the values sent before."""
+        context = {"devices": {s.id: s for s in self.states}}
+        ami._interpret_tokens(1, ami._statements([
+            "repeat 3 1 on +10 - +20", "1 on - -5 -", "reset", "1 on - - +1"]),
+            self.states, set(), context)
+        self.assertEqual(self.lights.set, [
+            "1 on 10 - 70", "1 on 20 - 90", "1 on 30 - 100", "1 on - 15 -",
+            "1 on - - 51"])
+        self.assertEqual(self.lights.reads, 0)
+        self.assertIs(ami._compile("1 on - - +10"), ami._compile("1 on - - +10"))
+
+
+    def test_terminate(self):
+        """ Terminating wakes a sleeping ambient immediately."""
+        ami.cancellations["7"] = ami._Cancellation()
+        sleeping = threading.Thread(target=ami._pause, args=("7", 10))
+        start = time.monotonic()
+        sleeping.start()
+        ami.terminate("7")
+        sleeping.join(2)
+        self.assertFalse(sleeping.is_alive())
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(ami.terminated("7"))
+        del ami.cancellations["7"]
+
+
+    def test_tokens(self):
+        """ Rendered lines are cleaned while the template is rendered."""
+        tokens = ami._tokens("{% for i in range(10**6) %}{{ i }} on  - -   {{ i }}\n{% endfor %}")
+        self.assertEqual(next(tokens), "0 on - - 0")
+        self.assertEqual(next(tokens), "1 on - - 1")
+        self.assertEqual(list(ami._lines(["a\nb", "c\n", "d"])), ["a", "bc", "d"])
+
+
+class Test_macros(unittest.TestCase):
+    """ Tests the macros of the share directory."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.dir.name, "ambients", "macros"))
+        fa.init(self.dir.name)
+        ami.init(fa, _Tasks(), _Lights([]))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _macro(self, name, content, mtime):
+        path = os.path.join(self.dir.name, "ambients", "macros", name)
+        with open(path, "w") as f: f.write(content)
+        os.utime(path, (mtime, mtime))
+
+
+    def test_edited(self):
+        """ An edited macro is used by scripts that already ran."""
+        self._macro("dim", "{% macro dim(id) %}{{ id }} on - - 10{% endmacro %}", 1)
+        self.assertEqual(ami.prepare("{{ dim(3) }}"), ["3 on - - 10"])
+        self._macro("dim", "{% macro dim(id) %}{{ id }} on - - 20{% endmacro %}", 2)
+        self.assertEqual(ami.prepare("{{ dim(3) }}"), ["3 on - - 20"])
+
+
+    def test_cross_file(self):
+        """ Macros call the macros of other files."""
+        self._macro("a", "{% macro a(id) %}{{ b(id) }}{% endmacro %}", 1)
+        self._macro("b", "{% macro b(id) %}{{ id }} off - - -{% endmacro %}", 1)
+        self.assertEqual(ami.prepare("{{ a(4) }}"), ["4 off - - -"])
+        self._macro("b", "{% macro b(id) %}{{ id }} on - - -{% endmacro %}", 2)
+        self.assertEqual(ami.prepare("{{ a(4) }}"), ["4 on - - -"])
+
+
+    def test_running(self):
+        """ Running ambients keep their macros while the macros reload."""
+        self._macro("dim", "{% macro dim(id) %}{{ id }} on - - 10{% endmacro %}", 1)
+        running = ami._tokens("{% for i in range(3) %}{{ dim(i) }}\n{% endfor %}")
+        self.assertEqual(next(running), "0 on - - 10")
+        os.remove(os.path.join(self.dir.name, "ambients", "macros", "dim"))
+        self._macro("off", "{% macro off(id) %}{{ id }} off - - -{% endmacro %}", 2)
+        self.assertEqual(ami.prepare("{{ off(5) }}"), ["5 off - - -"])
+        self.assertEqual(list(running), ["1 on - - 10", "2 on - - 10"])
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
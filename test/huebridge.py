@@ -0,0 +1,136 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+"""
+Local stand-in for the bridge REST API (lights and groups, keep-alive).
+Run it with 'python test/huebridge.py [port]' and set lightctl_backend to
+'http' and bridge_address to 'localhost:<port>'.
+"""
+
+import json
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _light(name, on, bri, hue=None, sat=None):
+    state = {"on": on, "bri": bri, "reachable": True}
+    if hue is not None: state["hue"] = hue
+    if sat is not None: state["sat"] = sat
+    return {"name": name, "state": state}
+
+
+class BridgeStub:
+    """ Serves lights and groups in memory."""
+
+    def __init__(self, port:int=0, user:str="test"):
+        """ Binds the server (port 0: any free port)."""
+        self.user = user
+        self.lights = {
+            "1":  _light("Couch",         True,  127,  7282, 229),
+            "2":  _light("Table",         True,  127),
+            "3":  _light("Desk",          False, 254),
+            "4":  _light("Bookshelf",     True,  203,  7282, 229),
+            "7":  _light("Shelf",         True,  203, 43690, 152),
+        }
+        self.groups = {
+            "1": {"name": "Office",      "lights": ["3", "4"]},
+            "2": {"name": "Living room", "lights": ["1", "2", "7"]},
+        }
+        self.requests = 0
+        self.connections = 0
+        self.mutex = threading.Lock()
+        self.server = ThreadingHTTPServer(("localhost", port), self._handler())
+        self.server.daemon_threads = True
+        self.address = f"localhost:{self.server.server_address[1]}"
+
+    def start(self):
+        """ Serves in a background thread."""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """ Stops serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _group(self, group:dict) -> dict:
+        """ Group with action and aggregated state."""
+        states = [self.lights[i]["state"] for i in group["lights"]]
+        action = dict(states[0]) if len(states) > 0 else {"on": False}
+        any_on = any(s["on"] for s in states)
+        all_on = all(s["on"] for s in states)
+        return {**group, "action": action,
+            "state": {"any_on": any_on, "all_on": all_on}}
+
+    def get(self, path:list[str]):
+        """ Handles GET."""
+        with self.mutex:
+            if path == ["lights"]: return self.lights
+            if path == ["groups"]:
+                return {i: self._group(g) for i, g in self.groups.items()}
+            if len(path) == 2 and path[0] == "lights":
+                return self.lights[path[1]]
+            if len(path) == 2 and path[0] == "groups":
+                return self._group(self.groups[path[1]])
+        raise KeyError("/".join(path))
+
+    def put(self, path:list[str], body:dict):
+        """ Handles PUT."""
+        with self.mutex:
+            if len(path) == 3 and path[0] == "lights" and path[2] == "state":
+                ids = [path[1]]
+            elif len(path) == 3 and path[0] == "groups" and path[2] == "action":
+                ids = self.groups[path[1]]["lights"]
+            else: raise KeyError("/".join(path))
+            for i in ids:
+                state = self.lights[i]["state"]
+                for k, v in body.items():
+                    if k == "on" or k in state: state[k] = v
+        base = "/".join(path[:-1])
+        return [{"success": {f"/{base}/{path[-1]}/{k}": v}} \
+            for k, v in body.items()]
+
+    def _handler(self):
+        """ Request handler bound to the stub."""
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def setup(self):
+                super().setup()
+                with stub.mutex: stub.connections += 1
+            def log_message(self, *args): pass
+            def do_GET(self): self._answer(lambda p: stub.get(p))
+            def do_PUT(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or "{}")
+                self._answer(lambda p: stub.put(p, body))
+            def _answer(self, handle):
+                with stub.mutex: stub.requests += 1
+                match = re.match(r"^/api/([^/]+)/(.*)$", self.path)
+                # errors are answered with status 200, like the bridge does
+                if match is None or match.group(1) != stub.user:
+                    status, data = 200, [{"error": {"type": 1,
+                        "address": self.path, "description": "unauthorized user"}}]
+                else:
+                    try:
+                        status, data = 200, handle(match.group(2).split("/"))
+                    except KeyError as e:
+                        status, data = 200, [{"error": {"type": 3,
+                            "address": self.path,
+                            "description": f"resource, {e}, not available"}}]
+                payload = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+        return Handler
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    stub = BridgeStub(port)
+    print(f"Bridge stand-in on {stub.address}, user '{stub.user}'.")
+    stub.server.serve_forever()
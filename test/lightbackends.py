@@ -0,0 +1,169 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+from services.lightbackends import Backend, Breaker, BridgeUnavailable, \
+    Bridges, HttpBackend, LightctlBackend
+from services.lightctlsession import CommandError
+from services.lightstates import State
+from huebridge import BridgeStub
+
+
+class Test_lightbackends(unittest.TestCase):
+    """ Tests the backends."""
+
+    def setUp(self):
+        self.bridge = BridgeStub().start()
+        self.backend = HttpBackend(self.bridge.address, self.bridge.user)
+
+    def tearDown(self):
+        self.backend.close()
+        self.bridge.stop()
+
+
+    def test_http_read(self):
+        """ Bridge values are converted to lightctl ranges."""
+        states = {s.id: s for s in self.backend.read()}
+        self.assertEqual(states["1"].str(), "1 on 40 90 50")
+        self.assertEqual(states["2"].str(), "2 on - - 50")
+        self.assertEqual(states["3"].pwr, "off")
+        self.assertEqual(states["7"].name, "Shelf")
+        groups = {s.id: s for s in self.backend.read("grp")}
+        self.assertEqual(groups["2"].memids, ["1", "2", "7"])
+        self.assertEqual(groups["1"].pwr, "on")
+
+
+    def test_http_write(self):
+        """ Written states can be read back."""
+        self.backend.write([State("1 on 120 50 25"), State("3 on - - 100")])
+        self.assertEqual(self.backend.read("dev", "1")[0].str(), "1 on 120 50 25")
+        self.assertEqual(self.backend.read("dev", "3")[0].str(), "3 on - - 100")
+        self.backend.write([State("2 off - - 10")], "grp")
+        self.assertEqual(self.backend.read("dev", "7")[0].pwr, "off")
+
+
+    def test_http_error(self):
+        """ Error answers of the bridge raise CommandError."""
+        unauthorized = HttpBackend(self.bridge.address, "nobody")
+        self.assertRaises(CommandError, unauthorized.read)
+        self.assertRaises(CommandError, unauthorized.write, [State("1 on - - 10")])
+        unauthorized.close()
+        self.assertRaises(CommandError, self.backend.read, "grp", "9")
+
+
+    def test_http_keep_alive(self):
+        """ Requests reuse the pooled connection."""
+        for _ in range(10): self.backend.read()
+        self.assertEqual(self.bridge.requests, 10)
+        self.assertEqual(self.bridge.connections, 1)
+
+
+    def test_lightctl_session(self):
+        """ The session returns the same results as single calls."""
+        once = LightctlBackend("./test/lightctl-test.sh")
+        session = LightctlBackend("./test/lightctl-test.sh", True)
+        self.assertEqual(
+            [s.str() for s in once.read()],
+            [s.str() for s in session.read()])
+        self.assertEqual(session.read("grp", "3")[0].memids, ["9", "13"])
+        session.close()
+
+
+    def test_lightctl_simulator(self):
+        """ The simulator keeps written states (single calls and session)."""
+        with tempfile.TemporaryDirectory() as dir:
+            executable = "python3 test/lightctlsim.py --devices=12 --groups=3 " \
+                f"--state={os.path.join(dir, 'house.json')}"
+            once = LightctlBackend(executable)
+            session = LightctlBackend(executable, True)
+            self.assertEqual(len(once.read()), 12)
+            self.assertEqual(session.read("grp", "2")[0].memids, ["2", "5", "8", "11"])
+            once.write([State("1 on 120 50 25"), State("3 on 10 10 60")])
+            self.assertEqual(session.read("dev", "1")[0].str(), "1 on 120 50 25")
+            self.assertEqual(session.read("dev", "3")[0].str(), "3 on - - 60")
+            session.write([State("2 off - - 10")], "grp")
+            self.assertEqual(once.read("dev", "5")[0].pwr, "off")
+            self.assertEqual(once.read("dev", "5")[0].bri, "10")
+            session.close()
+
+
+    def test_bridges(self):
+        """ IDs of additional bridges are namespaced and routed."""
+        second = BridgeStub().start()
+        bridges = Bridges({
+            "main": self.backend,
+            "second": HttpBackend(second.address, second.user)})
+        ids = [s.id for s in bridges.read()]
+        self.assertIn("1", ids)
+        self.assertIn("second:1", ids)
+        groups = {s.id: s for s in bridges.read("grp")}
+        self.assertEqual(groups["second:1"].memids, ["second:3", "second:4"])
+        bridges.write([State("second:3 on - - 10")])
+        self.assertEqual(bridges.read("dev", "second:3")[0].str(), "second:3 on - - 10")
+        self.assertEqual(self.backend.read("dev", "3")[0].pwr, "off")
+        self.assertEqual(bridges.bridge("second:3"), "second")
+        self.assertEqual(bridges.bridge("3"), "main")
+        bridges.close()
+        second.stop()
+
+
+    def test_timeout(self):
+        """ Hanging lightctl calls are killed."""
+        for use_session in [False, True]:
+            backend = LightctlBackend("sleep 5;", use_session, timeout=0.2)
+            start = time.monotonic()
+            self.assertRaises((subprocess.TimeoutExpired, TimeoutError),
+                backend.read)
+            self.assertLess(time.monotonic() - start, 2)
+            backend.close()
+
+
+    def test_breaker(self):
+        """ Calls fail fast while the bridge is down, probing recovers."""
+        class _Flaky(Backend):
+            down = True
+            calls = 0
+            def read(self, type="dev", id=None):
+                self.calls += 1
+                if self.down: raise OSError("unreachable")
+                return []
+        flaky = _Flaky()
+        breaker = Breaker(flaky, failures=2, probe=0.05)
+        for _ in range(2): self.assertRaises(OSError, breaker.read)
+        self.assertRaises(BridgeUnavailable, breaker.read)
+        self.assertFalse(breaker.available())
+        flaky.down = False
+        time.sleep(0.2)
+        self.assertTrue(breaker.available())
+        self.assertEqual(breaker.read(), [])
+        breaker.close()
+
+
+    def test_breaker_command_error(self):
+        """ Failed commands do not open the breaker."""
+        breaker = Breaker(self.backend, failures=2)
+        for _ in range(3):
+            self.assertRaises(CommandError, breaker.read, "dev", "99")
+        once = Breaker(LightctlBackend("./test/lightctl-test.sh"), failures=2)
+        for _ in range(3):
+            self.assertRaises(subprocess.CalledProcessError, once.exec, "bogus")
+        self.assertTrue(breaker.available())
+        self.assertTrue(once.available())
+        once.close()
+
+
+    def test_breaker_exit(self):
+        """ lightctl failing to read all states opens the breaker."""
+        breaker = Breaker(LightctlBackend("exit 1;"), failures=2, probe=10)
+        for _ in range(2):
+            self.assertRaises(subprocess.CalledProcessError, breaker.read)
+        self.assertRaises(BridgeUnavailable, breaker.read)
+        breaker.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
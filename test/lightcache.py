@@ -0,0 +1,44 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+import threading
+import time
+import unittest
+from services.lightcache import StateCache
+
+
+class Test_lightcache(unittest.TestCase):
+    """ Tests the state cache."""
+
+    def test_single_flight(self):
+        """ Concurrent readers share a single load."""
+        cache = StateCache(10)
+        loads = []
+        def _load():
+            loads.append(1)
+            time.sleep(0.05)
+            return "states"
+        threads = [threading.Thread(target=cache.get, args=("dev", _load)) \
+            for _ in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(cache.get("dev", _load), "states")
+
+
+    def test_stale(self):
+        """ The last value is served if loading fails."""
+        cache = StateCache(10)
+        def _fail(): raise OSError("unreachable")
+        self.assertRaises(OSError, cache.get, "dev", _fail)
+        cache.get("dev", lambda: "states")
+        cache.invalidate("dev")
+        self.assertEqual(cache.get("dev", _fail), "states")
+        self.assertTrue(cache.is_stale("dev"))
+        cache.invalidate()
+        cache.get("dev", lambda: "new")
+        self.assertFalse(cache.is_stale("dev"))
+
+
+if __name__ == '__main__':
+    unittest.main()
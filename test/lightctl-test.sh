@@ -1,5 +1,13 @@
 #!/bin/bash
 
+if [[ "$1" == "session" ]]; then
+    # long-lived mode: one command per line, answers end with "."
+    while read -r line; do
+        if "$0" $line; then echo "."; else echo "! failed: $line"; fi
+    done
+    exit 0
+fi
+
 if [[ "$@" =~ ^state-group.[0-9]+ ]]; then
     echo "   3 off 240  60 100 Kitchen [9,13]"
 
@@ -22,4 +30,11 @@ elif [[ "$@" =~ ^state  ]]; then
     echo "  10  on  80  90  50 Bedside table"
     echo "  11 off  20  90  80 Dresser"
     echo "  13  on   -   -  30 Pantry"
-fi
\ No newline at end of file
+
+elif [[ "$@" =~ ^set ]]; then
+    :
+
+else
+    echo "unknown command: $@" >&2
+    exit 1
+fi
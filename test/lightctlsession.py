@@ -0,0 +1,49 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+import unittest
+from services.lightctlsession import CommandError, Session, SessionError
+
+
+class Test_lightctlsession(unittest.TestCase):
+    """ Tests the lightctl co-process."""
+
+    def setUp(self):
+        self.session = Session("./test/lightctl-test.sh")
+
+    def tearDown(self):
+        self.session.close()
+
+
+    def test_exec(self):
+        """ Answers end at the marker line."""
+        self.assertEqual(self.session.exec("state 10 --brief"),
+            "  10  on  80  90  50 Bedside table\n")
+        self.assertEqual(len(self.session.exec("state --brief").splitlines()), 9)
+
+
+    def test_error_in_sync(self):
+        """ A failed command does not shift the following answers."""
+        with self.assertRaises(CommandError):
+            self.session.exec_many(["state 10", "bogus", "state-group 3"])
+        self.assertEqual(self.session.exec("state-group 3"),
+            "   3 off 240  60 100 Kitchen [9,13]\n")
+
+
+    def test_broken(self):
+        """ A session that cannot start is disabled after the failures."""
+        session = Session("false;", max_failures=2)
+        for _ in range(2): self.assertRaises(SessionError, session.exec, "state")
+        self.assertFalse(session.usable())
+
+
+    def test_timeout(self):
+        """ Missed deadlines restart the co-process, the session stays on."""
+        session = Session("sleep 5;", max_failures=2, timeout=0.1)
+        for _ in range(3): self.assertRaises(TimeoutError, session.exec, "state")
+        self.assertTrue(session.usable())
+        session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
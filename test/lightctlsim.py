@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+"""
+Simulates lightctl (same commands and output) with any number of devices and
+groups. The states are kept in a file, so they persist across calls and are
+shared by concurrent calls. Latency, jitter and the bridge rate limit can be
+set. Use it as lightctl_exec, e.g.
+  "lightctl_exec": "python3 test/lightctlsim.py --devices=200 --latency=40"
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import random
+import shlex
+import sys
+import tempfile
+import time
+
+
+class SimError(Exception):
+    """ The command failed."""
+
+
+def parser() -> argparse.ArgumentParser:
+    """ Options and command."""
+    p = argparse.ArgumentParser(description="Simulates lightctl.")
+    p.add_argument("--devices", type=int, default=20, help="number of devices")
+    p.add_argument("--groups", type=int, default=4, help="number of groups")
+    p.add_argument("--state", default=None, help="state file")
+    p.add_argument("--latency", type=float, default=0, help="ms per command")
+    p.add_argument("--jitter", type=float, default=0, help="+/- ms")
+    p.add_argument("--rate", type=float, default=0,
+        help="commands per second (0: unlimited)")
+    p.add_argument("--brief", action="store_true", help="ignored")
+    p.add_argument("--bridge", default=None, help="ignored")
+    p.add_argument("--user", default=None, help="ignored")
+    p.add_argument("cmd", help="state, state-group, set, set-group, session")
+    p.add_argument("args", nargs="*")
+    return p
+
+
+class Simulator:
+    """ Devices and groups in a state file."""
+
+    def __init__(self, options:argparse.Namespace):
+        """ Sets the options."""
+        self.options = options
+        self.path = options.state or os.path.join(tempfile.gettempdir(),
+            f"lightctlsim-{options.devices}-{options.groups}.json")
+
+    def run(self, cmd:str, args:list[str]) -> str:
+        """ Runs a command, returns the output."""
+        handlers = {
+            "state":       lambda h: self._state(h, "devices", args),
+            "state-group": lambda h: self._state(h, "groups", args),
+            "set":         lambda h: self._set(h, "devices", args),
+            "set-group":   lambda h: self._set(h, "groups", args),
+        }
+        if cmd not in handlers: raise SimError(f"unknown command '{cmd}'")
+        wait, output = self._locked(handlers[cmd])
+        delay = self.options.latency + random.uniform(
+            -self.options.jitter, self.options.jitter)
+        time.sleep(max(0, wait + delay / 1000))
+        return output
+
+    def session(self):
+        """ Long-lived mode: a command per line, answers end with '.' (or
+        '! <message>')."""
+        for line in sys.stdin:
+            if line.strip() == "": continue
+            try:
+                options = parser().parse_args(shlex.split(line))
+                output = self.run(options.cmd, options.args)
+                sys.stdout.write(output + ".\n")
+            except (SimError, SystemExit) as e:
+                sys.stdout.write(f"! {e}\n")
+            sys.stdout.flush()
+
+    def _locked(self, handle) -> tuple[float, str]:
+        """ Loads the house, handles the command and stores the changes
+        (exclusive lock). Returns the rate limit wait and the output."""
+        with open(self.path, "a+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.seek(0)
+            content = file.read()
+            house = json.loads(content) if content != "" else None
+            if house is None or house["size"] != self._size():
+                house = self._create()
+            wait = self._budget(house)
+            output, changed = handle(house)
+            if changed or content == "" or self.options.rate > 0:
+                file.seek(0)
+                file.truncate()
+                json.dump(house, file)
+            return wait, output
+
+    def _size(self) -> list[int]:
+        """ Number of devices and groups."""
+        return [self.options.devices, self.options.groups]
+
+    def _create(self) -> dict:
+        """ Creates devices (every third one white only) and groups (devices
+        assigned round-robin)."""
+        rnd = random.Random(self.options.devices)
+        devices = dict()
+        for i in range(1, self.options.devices + 1):
+            color = i % 3 != 0
+            devices[str(i)] = {
+                "name": f"Light {i}",
+                "pwr":  rnd.choice(["on", "off"]),
+                "hue":  str(rnd.randrange(360)) if color else "-",
+                "sat":  str(rnd.randrange(101)) if color else "-",
+                "bri":  str(rnd.randrange(1, 101)),
+            }
+        groups = dict()
+        for g in range(1, self.options.groups + 1):
+            groups[str(g)] = {
+                "name": f"Room {g}",
+                "memids": [str(i) for i in range(1, self.options.devices + 1) \
+                    if (i - 1) % self.options.groups == g - 1],
+            }
+        return {"size": self._size(), "devices": devices, "groups": groups,
+            "budget": [time.time(), self.options.rate]}
+
+    def _budget(self, house:dict) -> float:
+        """ Takes a token of the rate limit, returns the wait (seconds)."""
+        rate = self.options.rate
+        if rate <= 0: return 0
+        last, tokens = house["budget"]
+        now = time.time()
+        tokens = min(rate, tokens + (now - last) * rate) - 1
+        house["budget"] = [now, tokens]
+        return 0 if tokens >= 0 else -tokens / rate
+
+    def _state(self, house:dict, kind:str, args:list[str]) -> tuple[str, bool]:
+        """ Prints the states."""
+        ids = args[:1] if len(args) > 0 else \
+            sorted(house[kind].keys(), key=int)
+        lines = [self._line(house, kind, self._get(house, kind, i), i) \
+            for i in ids]
+        return "".join(line + "\n" for line in lines), False
+
+    def _line(self, house:dict, kind:str, entry:dict, id:str) -> str:
+        """ A state line ('id pwr hue sat bri name [members]')."""
+        if kind == "devices":
+            values = entry
+            suffix = ""
+        else:
+            members = [house["devices"][m] for m in entry["memids"]]
+            values = members[0] if len(members) > 0 \
+                else {"hue": "-", "sat": "-", "bri": "-"}
+            values = {**values,
+                "pwr": "on" if any(m["pwr"] == "on" for m in members) else "off"}
+            suffix = f" [{','.join(entry['memids'])}]"
+        return f"{id:>4} {values['pwr']:>3} {values['hue']:>3} " \
+            f"{values['sat']:>3} {values['bri']:>3} {entry['name']}{suffix}"
+
+    def _set(self, house:dict, kind:str, args:list[str]) -> tuple[str, bool]:
+        """ Sets power, hue, saturation and brightness ('-': unchanged)."""
+        if len(args) != 5: raise SimError("expected: <id> <pwr> <hue> <sat> <bri>")
+        id, pwr, hue, sat, bri = args
+        entry = self._get(house, kind, id)
+        if pwr not in ["on", "off", "-"]: raise SimError(f"invalid power '{pwr}'")
+        targets = [entry] if kind == "devices" \
+            else [house["devices"][m] for m in entry["memids"]]
+        for t in targets:
+            if pwr != "-": t["pwr"] = pwr
+            for attr, value, maximum in [
+                ("hue", hue, 360), ("sat", sat, 100), ("bri", bri, 100)]:
+                if value == "-" or t[attr] == "-": continue
+                try: number = int(value)
+                except ValueError: raise SimError(f"invalid {attr} '{value}'")
+                t[attr] = str(number % 360 if attr == "hue" \
+                    else max(0, min(maximum, number)))
+        return "", True
+
+    def _get(self, house:dict, kind:str, id:str) -> dict:
+        """ Gets a device or group."""
+        entry = house[kind].get(str(id))
+        if entry is None: raise SimError(f"unknown ID '{id}'")
+        return entry
+
+
+if __name__ == '__main__':
+    options = parser().parse_args()
+    simulator = Simulator(options)
+    if options.cmd == "session":
+        simulator.session()
+        sys.exit(0)
+    try:
+        sys.stdout.write(simulator.run(options.cmd, options.args))
+    except SimError as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(1)
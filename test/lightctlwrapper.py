@@ -0,0 +1,58 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+import unittest
+import services.lightctlwrapper as lw
+from services.lightbackends import Backend
+from services.lightstates import State
+
+
+class _Bridge(Backend):
+    """ Devices in memory, the bridge can go down."""
+
+    def __init__(self):
+        self.states = {"1": "1 on 40 90 50 Couch", "2": "2 off - - 20 Table"}
+        self.down = False
+
+    def read(self, type="dev", id=None):
+        if self.down: raise OSError("unreachable")
+        if type == "grp": return []
+        return [State(s) for s in self.states.values()]
+
+    def write(self, states, type="dev"):
+        if self.down: raise OSError("unreachable")
+        for s in states: self.states[s.id] = f"{s.str()} {self.states[s.id].split()[-1]}"
+
+
+class Test_lightctlwrapper(unittest.TestCase):
+    """ Tests the cached device states of the wrapper."""
+
+    def setUp(self):
+        self.bridge = _Bridge()
+        lw.init(self.bridge, cache_ttl=0)
+
+    def tearDown(self):
+        lw.dispatcher.close()
+
+
+    def test_write_through(self):
+        """ Written states are served without reading the bridge again."""
+        lw.init(self.bridge, cache_ttl=60)
+        lw.states()
+        lw.set_state(State("2 on - - 80")).result(timeout=5)
+        self.bridge.down = True
+        self.assertEqual(lw.state("dev", 2).str(), "2 on - - 80")
+
+
+    def test_failed_write(self):
+        """ States that did not reach the bridge are not served."""
+        lw.states()
+        self.bridge.down = True
+        future = lw.set_state(State("1 off 40 90 50"))
+        self.assertRaises(OSError, future.result, 5)
+        self.assertEqual(lw.state("dev", 1).str(), "1 on 40 90 50")
+        self.assertTrue(lw.stale())
+
+
+if __name__ == '__main__':
+    unittest.main()
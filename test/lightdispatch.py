@@ -0,0 +1,133 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+import threading
+import time
+import unittest
+from services.lightdispatch import Dispatcher, gather
+
+
+class Test_lightdispatch(unittest.TestCase):
+    """ Tests the write dispatcher."""
+
+    def setUp(self):
+        self.sent = []
+        self.inflight = 0
+        self.inflight_max = 0
+        self.mutex = threading.Lock()
+
+    def _send(self, bridge, states):
+        with self.mutex:
+            self.inflight += 1
+            self.inflight_max = max(self.inflight_max, self.inflight)
+        time.sleep(0.01)
+        with self.mutex:
+            self.inflight -= 1
+            self.sent += states
+
+
+    def test_order_per_device(self):
+        """ Writes to the same device keep their order."""
+        dispatcher = Dispatcher(self._send, workers=4, per_bridge=4, batch=1)
+        futures = [dispatcher.submit(f"dev-{i % 3}", [(i % 3, i)]) \
+            for i in range(30)]
+        gather(futures).result(timeout=5)
+        dispatcher.close()
+        for dev in range(3):
+            values = [v for d, v in self.sent if d == dev]
+            self.assertEqual(values, sorted(values))
+
+
+    def test_bridge_cap(self):
+        """ The in-flight writes per bridge are capped."""
+        dispatcher = Dispatcher(self._send, workers=8, per_bridge=2, batch=1)
+        futures = [dispatcher.submit(f"dev-{i}", [i]) for i in range(16)]
+        gather(futures).result(timeout=5)
+        dispatcher.close()
+        self.assertEqual(len(self.sent), 16)
+        self.assertLessEqual(self.inflight_max, 2)
+
+
+    def test_error(self):
+        """ Failed writes complete the future with the error."""
+        def _fail(bridge, states): raise Exception("unreachable")
+        dispatcher = Dispatcher(_fail)
+        future = dispatcher.submit("dev-1", [1])
+        self.assertRaises(Exception, future.result, 5)
+        dispatcher.close()
+
+
+    def test_merge(self):
+        """ Pending writes of a device are replaced by newer ones."""
+        dispatcher = Dispatcher(self._send, workers=1, batch=1)
+        futures = [dispatcher.submit("dev-1", [i]) for i in range(20)]
+        gather(futures).result(timeout=5)
+        stats = dispatcher.stats()
+        dispatcher.close()
+        self.assertEqual(self.sent[-1], 19)
+        self.assertLess(len(self.sent), 20)
+        self.assertEqual(stats["merged"] + len(self.sent), 20)
+
+
+    def test_rate(self):
+        """ The commands per second are limited."""
+        dispatcher = Dispatcher(self._send, workers=4, batch=1, rate=20)
+        start = time.monotonic()
+        futures = [dispatcher.submit(f"dev-{i}", [i]) for i in range(30)]
+        gather(futures).result(timeout=5)
+        dispatcher.close()
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+
+
+    def test_rate_alarm(self):
+        """ Alarm writes are not held back by the budget."""
+        dispatcher = Dispatcher(self._send, workers=4, batch=1, rate=10)
+        start = time.monotonic()
+        futures = [dispatcher.submit([f"dev-{i}" for i in range(10)],
+            list(range(10)), origin="alarm") for _ in range(3)]
+        gather(futures).result(timeout=5)
+        duration = time.monotonic() - start
+        dispatcher.submit("dev-1", [1]).result(timeout=5)
+        dispatcher.close()
+        self.assertLess(duration, 0.5)
+        # the other lanes wait for the commands taken by the alarm
+        self.assertGreaterEqual(time.monotonic() - start, 1.5)
+
+
+    def test_several_devices(self):
+        """ A write of several devices keeps the order of their writes."""
+        dispatcher = Dispatcher(self._send, workers=4, per_bridge=4, batch=1)
+        futures = [dispatcher.submit("dev-1", ["1a"]),
+            dispatcher.submit(["dev-1", "dev-2", "dev-3"], ["F1", "F2", "F3"],
+                origin="alarm"),
+            dispatcher.submit("dev-2", ["2b"]),
+            dispatcher.submit("dev-3", ["3b"])]
+        gather(futures).result(timeout=5)
+        stats = dispatcher.stats()
+        dispatcher.close()
+        sent = self.sent
+        self.assertLess(sent.index("1a"), sent.index("F1"))
+        self.assertEqual(sent.index("F1") + 1, sent.index("F2"))
+        self.assertLess(sent.index("F3"), sent.index("2b"))
+        self.assertLess(sent.index("F3"), sent.index("3b"))
+        self.assertEqual(stats["queued"], 0)
+
+
+    def test_lanes(self):
+        """ Interactive writes preempt ambients, ambients take turns."""
+        dispatcher = Dispatcher(self._send, workers=1, per_bridge=1, batch=1)
+        blocker = dispatcher.submit("dev-0", ["X"], origin="ambient/0")
+        futures = [dispatcher.submit(f"dev-a{i}", [f"A{i}"], origin="ambient/1") \
+            for i in range(3)]
+        futures += [dispatcher.submit(f"dev-b{i}", [f"B{i}"], origin="ambient/2") \
+            for i in range(3)]
+        futures.append(dispatcher.submit("dev-i", ["I"]))
+        gather([blocker, *futures]).result(timeout=5)
+        dispatcher.close()
+        sent = [s for s in self.sent if s != "X"]
+        self.assertEqual(sent[0], "I")
+        self.assertEqual(sent[1:], ["A0", "B0", "A1", "B1", "A2", "B2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
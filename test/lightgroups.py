@@ -0,0 +1,50 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+import unittest
+from services.lightgroups import Aggregates
+from services.lightstates import State
+
+
+class Test_lightgroups(unittest.TestCase):
+    """ Tests the group aggregates."""
+
+    def setUp(self):
+        self.devices = {s.id: s for s in [
+            State("1 on 40 90 50 Couch"),
+            State("2 on - - 20 Table"),
+            State("3 off 120 60 100 Desk")]}
+        self.groups = {s.id: s for s in [
+            State("1 on 0 0 0 Office [3]"),
+            State("2 on 0 0 0 Living room [1,2]"),
+            State("3 on 0 0 0 Empty []")]}
+        self.aggregates = Aggregates(self.groups, self.devices)
+
+    def _heads(self):
+        return {h.id: h for h in self.aggregates.get()}
+
+
+    def test_build(self):
+        """ Groups average the member values."""
+        heads = self._heads()
+        self.assertEqual(heads["2"].str(), "2 on 40 90 35")
+        self.assertTrue(heads["2"].has_hue)
+        self.assertEqual(heads["1"].str(), "1 off 120 60 100")
+        self.assertEqual(heads["3"].pwr, "off")
+        self.assertEqual(heads["3"].bri, "-")
+        self.assertEqual(self.groups["2"].bri, "0")
+
+
+    def test_refresh(self):
+        """ A changed device updates its groups."""
+        self.devices["1"] = State("1 off 40 90 10 Couch")
+        self.aggregates.refresh("1")
+        self.assertEqual(self._heads()["2"].str(), "2 on 40 90 15")
+        self.devices["2"] = State("2 off - - 20 Table")
+        self.aggregates.refresh("2")
+        self.assertEqual(self._heads()["2"].pwr, "off")
+        self.assertEqual(self._heads()["1"].str(), "1 off 120 60 100")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from services.lightshared import SharedSnapshot
+from services.lightstates import State
+
+
+class Test_lightshared(unittest.TestCase):
+    """ Tests the snapshot shared by the workers."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "lightstates.db")
+        self.reads = 0
+        self.mutex = threading.Lock()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _read(self):
+        with self.mutex: self.reads += 1
+        time.sleep(0.05)
+        states = [State("1 on 40 90 50 Couch"), State("2 off - - 20 Table")]
+        return {s.id: s for s in states}
+
+
+    def test_single_poller(self):
+        """ Concurrent workers read the bridge once."""
+        workers = [SharedSnapshot(self.path) for _ in range(4)]
+        results = []
+        def _get(worker): results.append(worker.get("dev", self._read))
+        threads = [threading.Thread(target=_get, args=(w,)) for w in workers]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(self.reads, 1)
+        self.assertEqual([r["1"].str() for r in results], ["1 on 40 90 50"] * 4)
+        self.assertIs(workers[0].get("dev", self._read),
+            workers[0].get("dev", self._read))
+
+
+    def test_update(self):
+        """ Written states are seen by the other workers."""
+        first, second = SharedSnapshot(self.path), SharedSnapshot(self.path)
+        first.get("dev", self._read)
+        def _change(states): states["2"] = State("2 on - - 80 Table")
+        first.update("dev", ["2"], _change)
+        self.assertEqual(second.get("dev", self._read)["2"].str(), "2 on - - 80")
+        self.assertEqual(second.get("dev", self._read)["2"].name, "Table")
+        self.assertEqual(self.reads, 1)
+
+
+    def test_update_rows(self):
+        """ Only the written devices are stored and read again."""
+        first, second = SharedSnapshot(self.path), SharedSnapshot(self.path)
+        first.get("dev", self._read)
+        before = second.get("dev", self._read)
+        def _change(states):
+            self.assertEqual(list(states.keys()), ["1"])
+            states["1"] = State("1 off 40 90 50 Couch")
+        first.update("dev", ["1"], _change)
+        after = second.get("dev", self._read)
+        self.assertIsNot(after, before)
+        self.assertEqual(after["1"].pwr, "off")
+        self.assertIs(after["2"], before["2"])
+
+
+    def test_expiry(self):
+        """ Outdated snapshots are read again."""
+        worker = SharedSnapshot(self.path, ttl=0.1)
+        worker.get("dev", self._read)
+        time.sleep(0.15)
+        worker.get("dev", self._read)
+        self.assertEqual(self.reads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+import unittest
+from services.lightstates import States
+
+
+class Test_lightstates(unittest.TestCase):
+    """ Tests the indexed states."""
+
+    def setUp(self):
+        self.states = States(
+            "1 on 40 90 50 Couch\n"
+            "2 on - - 20 Table\n"
+            "3 off 120 60 100 Desk\n"
+            "4 on - - 10 Table\n")
+        self.groups = States(
+            "1 on 40 90 50 Living room [1,2]\n"
+            "2 off - - - Empty []\n")
+
+
+    def test_lookup(self):
+        """ States are found by ID and name."""
+        self.assertEqual(self.states.get(3).name, "Desk")
+        self.assertIsNone(self.states.get(5))
+        self.assertEqual([s.id for s in self.states.named(["Table", "Couch"])],
+            ["2", "4", "1"])
+        self.assertEqual([s.id for s in self.states.named("Table")], ["2", "4"])
+
+
+    def test_members(self):
+        """ Member sets select the devices of a group."""
+        self.assertEqual(self.groups.members(1), frozenset(["1", "2"]))
+        self.assertEqual(self.groups.members(7), frozenset())
+        members = self.states.subset(self.groups.members("1"))
+        self.assertEqual([s.name for s in members.items], ["Couch", "Table"])
+
+
+if __name__ == '__main__':
+    unittest.main()
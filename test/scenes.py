@@ -0,0 +1,66 @@
+# This file is part of HOMEctlx. Copyright (C) 2024 Christian Rauch.
+# Distributed under terms of the GPL3 license.
+
+import os
+import tempfile
+import unittest
+import services.fileaccess as fa
+import services.scenes as sc
+from services.lightstates import State
+
+
+class _Lights:
+    """ Current states, records the written batches."""
+
+    def __init__(self, lines:list[str]):
+        self.current = [State(l) for l in lines]
+        self.batches = []
+
+    def states(self): return self.current
+
+    def set_batch(self, states, origin="interactive"):
+        self.batches.append([s.str() for s in states])
+
+
+class Test_scenes(unittest.TestCase):
+    """ Tests capturing and restoring scenes."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.dir.name, "scenes"))
+        fa.init(self.dir.name)
+        self.lights = _Lights([
+            "1 on 40 90 50 Couch",
+            "2 on - - 20 Table",
+            "3 off 120 60 100 Desk"])
+        sc.init(fa, self.lights)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+
+    def test_restore_diff(self):
+        """ Only changed devices are written, in a single batch."""
+        sc.capture("night")
+        self.assertEqual(sc.all(), ["night"])
+        self.lights.current = [
+            State("1 on 40 90 80 Couch"),
+            State("2 on - - 20 Table"),
+            State("3 off 0 0 10 Desk")]
+        sc.restore("night")
+        self.assertEqual(self.lights.batches, [["1 on 40 90 50"]])
+
+
+    def test_restore_power(self):
+        """ Switched devices are written with all values."""
+        sc.capture("night")
+        self.lights.current = [
+            State("1 off 40 90 50 Couch"),
+            State("2 on - - 20 Table"),
+            State("3 on 120 60 100 Desk")]
+        sc.restore("night")
+        self.assertEqual(self.lights.batches, [["1 on 40 90 50", "3 off 120 60 100"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,16 +8,13 @@ View-model for alarms and timers.
 from datetime import datetime, timedelta
 import services.lightctlwrapper as lw
 import services.scheduler as sd
-from services.lightstates import States
 import services.meta as m
 
 
 def ctl() -> list[m.view]:
     """ Starting point."""
 
-    states_txt = lw.exec(f"state", brief=False)
-    states = States('\n'.join(states_txt.split('\n')[1:]))
-    names = sorted([s.name for s in states.items])
+    names = sorted([s.name for s in lw.states()])
 
     default = datetime.now() + timedelta(hours=8)
 
@@ -10,6 +10,7 @@ from random import choice
 import time
 import services.lightctlwrapper as lw
 import services.ambinterpreter as ami
+import services.scenes as sc
 from services.lightstates import State, States
 import services.meta as m
 
@@ -30,6 +31,12 @@ def ctl() -> list[m.view]:
             m.triggers("ambients/run", "name", m.choice.makelist(ambients))
         ], True, False))
 
+    scenes = sc.all()
+    if len(scenes) > 0:
+        forms.append(m.form("a-scenes", "scenes", [
+            m.triggers("ambients/recall", "name", m.choice.makelist(scenes))
+        ], True, False))
+
     forms += forms_running[1:]
 
     if len(ambients_and_macros) > 0:
@@ -43,6 +50,12 @@ def ctl() -> list[m.view]:
             m.execute("ambients/edit", "create"),
         ]))
 
+    forms.append(
+        m.form("a-capture", "capture scene", [
+            m.text("name", _name_suggestion()),
+            m.execute("ambients/capture", "capture"),
+        ]))
+
     return [
         m.view("_body", "ambients", forms), 
         m.header([m.applink("/lights/ctl", "💡 lights")])]
@@ -84,6 +97,9 @@ def states():
 
     if len(fields_on) == 0: fields_on.append(m.label("no active devices"))
 
+    if lw.stale():
+        fields_on.insert(0, m.label("bridge unavailable, the states may be outdated"))
+
     if len(fields_off) == 0: fields_off.append(m.label("all devices active"))
     else: 
         fields_off.insert(0, m.title("inactive"))
@@ -97,8 +113,8 @@ def states():
 
 def set_state(type:str, id:str, value:str, attr:str) -> list[m.view]:
     """ Set states."""
-    ids = [id] if type != "grp" else lw.get_ids_in_group(id)
-    lw.set_attributes(ids, attr, value)
+    if type == "grp": lw.set_group_attribute(id, attr, value)
+    else: lw.set_attributes([id], attr, value)
     return running()
 
 
@@ -111,15 +127,18 @@ def set(names, pwr="off", hue:int=-1, sat:int=-1, bri:int=-1):
     sat = "-" if sat in [-1, "-1"] else int(sat)
     bri = "-" if bri in [-1, "-1"] else int(bri)
 
-    states = lw.states()
+    states = States.of(lw.states())
 
-    if names == "*": ids = [int(s.id) for s in states]
-    else:            ids = [int(s.id) for s in states if s.name in names]
+    # the JSON API passes comma-separated names
+    if isinstance(names, str) and names != "*": names = names.split(",")
+
+    if names == "*": ids = [s.id for s in states.items]
+    else:            ids = [s.id for s in states.named(names)]
 
     values = f"{pwr} {hue} {sat} {bri}"
-    for id in ids: lw.set_state(State(f"{id} {values}"))
+    lw.set_batch([State(f"{id} {values}") for id in ids]).result()
 
-    states_new = lw.exec(f'state', brief=False)
+    states_new = "\n".join([f"{s.str()} {s.name}" for s in lw.states()])
     return [m.text_big_ro("s-resp", f"FOR {ids}\nSET {values}\n\n{states_new}")]
 
 
@@ -189,6 +208,18 @@ def run(name):
     return ctl()
 
 
+def capture(name):
+    """ Captures the current device states as scene."""
+    sc.capture(name)
+    return ctl()
+
+
+def recall(name):
+    """ Restores a scene."""
+    sc.restore(name)
+    return ctl()
+
+
 def _builtin():
     """ Returns the built-in variables."""
     predefined = ami.predefined()
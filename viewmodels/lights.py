@@ -13,10 +13,11 @@ import services.meta as m
 
 def ctl() -> list[m.view]:
     """ Starting point."""
+    states = lw.states_grouped("grp")
     forms = [m.form(None, "lights", [
+        *_stale(),
         m.execute("lights/all_off", "turn all off"),
         m.space(1)], True, False)]
-    states = lw.states_grouped("grp")
     for grp in states:
         fields = []
         fields.append(m.light("lights/set", grp))
@@ -27,10 +28,16 @@ def ctl() -> list[m.view]:
         m.header([m.applink("/ambients/ctl", "🌴 ambients")])]
 
 
+def _stale() -> list:
+    """ Notice shown while the bridge is unavailable."""
+    if not lw.stale(): return []
+    return [m.label("bridge unavailable, the states may be outdated")]
+
+
 def set(type:str, id:str, value:str, attr:str) -> list[m.view]:
     """ Set states."""
-    ids = [id] if type != "grp" else lw.get_ids_in_group(id)
-    lw.set_attributes(ids, attr, value)
+    if type == "grp": lw.set_group_attribute(id, attr, value)
+    else: lw.set_attributes([id], attr, value)
     return ctl()
 
 
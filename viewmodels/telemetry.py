@@ -9,6 +9,8 @@ from datetime import datetime
 import subprocess
 import services.meta as m
 import services.fileaccess as fa
+import services.lightctlwrapper as lw
+import services.lightmetrics as lm
 
 
 def ctl() -> list[m.view]:
@@ -24,10 +26,24 @@ def ctl() -> list[m.view]:
                 *health(routines()[:3]),
                 m.space(2)
             ], True, True),
+            lights(),
             logs()
         ])]
 
 
+def lights():
+    """ Light control statistics."""
+    def _lines(stats): return "\n".join([f"{k}: {v}" for k, v in stats.items()])
+    cache = _lines(lw.cache_stats())
+    writes = _lines(lw.dispatch_stats())
+    return m.form("li", "lights", [
+                m.text_big_ro("li-s",
+                    f"bridge calls\n\n{lm.report()}\n\n"
+                    f"state cache\n\n{cache}\n\nwrite queue\n\n{writes}"),
+                m.autoupdate("telemetry/lights", 5000)
+            ], False, False)
+
+
 def logs():
     logs = fa.read_file(["temp", "logs"])
     return m.form("lo", "logs", [